@@ -0,0 +1,51 @@
+import json
+import os
+from pathlib import Path
+from loguru import logger
+
+CONFIG_FILE = Path("config.json")
+DEFAULT_ACCOUNT = "default"
+
+def read_config():
+    if CONFIG_FILE.exists():
+        try:
+            with open(CONFIG_FILE, "r") as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"Error loading config.json: {e}")
+    return {}
+
+def load_accounts():
+    """Load named Gemini credential sets from config.json or fallback to .env
+
+    config.json holds {"accounts": {name: {"GEMINI_1PSID", "GEMINI_1PSIDTS", "proxy"}}};
+    the older flat {"GEMINI_1PSID", "GEMINI_1PSIDTS"} layout is the "default" account.
+    """
+    config = read_config()
+    if config.get("accounts"):
+        return config["accounts"]
+
+    return {
+        DEFAULT_ACCOUNT: {
+            "GEMINI_1PSID": config.get("GEMINI_1PSID") or os.getenv("GEMINI_1PSID"),
+            "GEMINI_1PSIDTS": config.get("GEMINI_1PSIDTS") or os.getenv("GEMINI_1PSIDTS"),
+            "proxy": os.getenv("GEMINI_PROXY"),
+        }
+    }
+
+def save_cookies(psid: str, psidts: str, account: str = DEFAULT_ACCOUNT):
+    """Save updated cookies for one account to config.json, keeping the others"""
+    config = read_config()
+    accounts = config.setdefault("accounts", {})
+    if "GEMINI_1PSID" in config:
+        # Migrate the flat single-account layout
+        accounts.setdefault(DEFAULT_ACCOUNT, {
+            "GEMINI_1PSID": config.pop("GEMINI_1PSID"),
+            "GEMINI_1PSIDTS": config.pop("GEMINI_1PSIDTS", None),
+        })
+    accounts.setdefault(account, {}).update({"GEMINI_1PSID": psid, "GEMINI_1PSIDTS": psidts})
+
+    tmp_file = CONFIG_FILE.with_suffix(".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(config, f, indent=2)
+    os.replace(tmp_file, CONFIG_FILE)
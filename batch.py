@@ -0,0 +1,239 @@
+"""Bulk catalog generation without the HTTP server.
+
+Usage:
+    python batch.py catalog/                   # every image in a directory
+    python batch.py "catalog/**/*.jpg"         # a glob pattern
+    python batch.py products.csv               # a manifest with sku,path columns
+
+Products found in a directory or glob are keyed by their path relative to it,
+so catalog/skuA/main.jpg is written to <output>/skuA/main/.
+
+Progress is checkpointed to an append-only JSONL state file, so an interrupted
+run picks up where it left off; finished products are skipped on restart.
+"""
+import argparse
+import asyncio
+import csv
+import glob
+import json
+import re
+import time
+from pathlib import Path
+from dotenv import load_dotenv
+from loguru import logger
+from accounts import load_accounts
+from client_pool import ClientPool
+import postprocess
+from result_cache import ResultCache
+from shot_profiles import get_profile
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+
+def discover_products(source: str):
+    """Returns [(sku, path)] from a directory, glob pattern or CSV manifest.
+
+    Discovered files are keyed by their path relative to the source (catalog/skuA/main.jpg
+    becomes skuA/main), so same-named images in different folders stay separate products.
+    Raises ValueError if two products end up with the same SKU.
+    """
+    path = Path(source)
+    if path.suffix.lower() == ".csv":
+        products = []
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                image_path = Path(row["path"])
+                if not image_path.is_absolute():
+                    image_path = path.parent / image_path
+                products.append((safe_sku(row.get("sku") or image_path.stem), image_path))
+        return check_unique_skus(products, f"{source} lists")
+
+    if path.is_dir():
+        root = path
+        files = sorted(p for p in path.rglob("*") if p.suffix.lower() in IMAGE_EXTENSIONS)
+    else:
+        root = glob_root(source)
+        files = sorted(Path(p) for p in glob.glob(source, recursive=True))
+    products = [(relative_sku(p, root), p) for p in files if p.suffix.lower() in IMAGE_EXTENSIONS]
+    return check_unique_skus(products, f"{source} has")
+
+def glob_root(pattern: str) -> Path:
+    """The directory part of a glob pattern before its first wildcard."""
+    parts = []
+    for part in Path(pattern).parts[:-1]:
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return Path(*parts) if parts else Path(".")
+
+def relative_sku(image_path: Path, root: Path) -> str:
+    try:
+        relative = image_path.relative_to(root)
+    except ValueError:
+        relative = Path(image_path.name)
+    return "/".join(safe_sku(part) for part in relative.with_suffix("").parts)
+
+def check_unique_skus(products, origin: str):
+    paths = {}
+    for sku, image_path in products:
+        if sku in paths:
+            raise ValueError(f"{origin} duplicate SKU {sku!r}: {paths[sku]} and {image_path}")
+        paths[sku] = image_path
+    return products
+
+def safe_sku(sku: str) -> str:
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", sku).strip("._") or "product"
+
+def load_state(state_file: Path):
+    """Latest checkpoint record per SKU.
+
+    A crash mid-write can leave a truncated last line; it is skipped, so that
+    product simply runs again.
+    """
+    state = {}
+    if state_file.exists():
+        with open(state_file) as f:
+            lines = [line for line in f if line.strip()]
+        for number, line in enumerate(lines, 1):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                if number < len(lines):
+                    raise
+                logger.warning(f"Ignoring truncated last line of {state_file}")
+                continue
+            state[record["sku"]] = record
+    return state
+
+class Checkpoint:
+    def __init__(self, state_file: Path):
+        self.state_file = state_file
+        self.records = load_state(state_file)
+        self._terminate_last_line()
+
+    def _terminate_last_line(self):
+        """Drops a truncated last line so new records are not appended onto it."""
+        if not self.state_file.exists():
+            return
+        with open(self.state_file, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                last = data[data.rfind(b"\n") + 1:]
+                try:
+                    json.loads(last)
+                    f.write(b"\n")
+                except ValueError:
+                    f.truncate(len(data) - len(last))
+
+    def record(self, **record):
+        record["finished_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.records[record["sku"]] = record
+        # One line per product, flushed immediately so a crash loses at most the products in flight
+        with open(self.state_file, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+def write_report(report_file: Path, products, checkpoint: Checkpoint):
+    with open(report_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["sku", "path", "status", "images", "results", "error"])
+        for sku, image_path in products:
+            record = checkpoint.records.get(sku, {})
+            results = record.get("results", [])
+            writer.writerow([
+                sku, str(image_path), record.get("status", "pending"),
+                len(results), ";".join(results), record.get("error", ""),
+            ])
+
+async def run_batch(products, output_dir: Path, checkpoint: Checkpoint, concurrency: int = 2,
+                    shot_concurrency: int = None, retry_failed: bool = False, cache=None, variants: bool = False,
+                    profile=None):
+    skip = {"done", "failed"} if not retry_failed else {"done"}
+    todo = [(sku, p) for sku, p in products if checkpoint.records.get(sku, {}).get("status") not in skip]
+    logger.info(f"{len(products)} products, {len(products) - len(todo)} already checkpointed, {len(todo)} to run")
+    if not todo:
+        return
+
+    pool = ClientPool(concurrency, load_accounts)
+    queue = asyncio.Queue()
+    for product in todo:
+        queue.put_nowait(product)
+    counter = {"finished": 0}
+
+    async def worker():
+        while not queue.empty():
+            sku, image_path = queue.get_nowait()
+            started = time.monotonic()
+            try:
+                if not image_path.exists():
+                    raise FileNotFoundError(f"Input image not found: {image_path}")
+                async with pool.acquire() as generator:
+                    # Per-SKU folders keep identically named source images apart
+                    results = await generator.generate_for_image(
+                        image_path, output_dir / sku, concurrency=shot_concurrency, cache=cache, profile=profile
+                    )
+                if not results:
+                    raise RuntimeError("Gemini returned no images for any shot")
+                if variants:
+                    await postprocess.process_images(results)
+                checkpoint.record(sku=sku, path=str(image_path), status="done", results=results,
+                                  seconds=round(time.monotonic() - started, 1))
+            except Exception as e:
+                logger.error(f"{sku} failed: {e}")
+                # ShotsFailed carries the shots that did save; the cache skips them on --retry-failed
+                checkpoint.record(sku=sku, path=str(image_path), status="failed", results=getattr(e, "results", []), error=str(e),
+                                  seconds=round(time.monotonic() - started, 1))
+            counter["finished"] += 1
+            logger.info(f"[{counter['finished']}/{len(todo)}] {sku}: {checkpoint.records[sku]['status']}")
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        await pool.close()
+        postprocess.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate product shot sets for a whole catalog.")
+    parser.add_argument("source", help="Directory, glob pattern, or CSV manifest (sku,path)")
+    parser.add_argument("--output", type=Path, default=Path("output_product_set"), help="Output directory (one folder per SKU)")
+    parser.add_argument("--concurrency", type=int, default=2, help="Products generated at once")
+    parser.add_argument("--shot-concurrency", type=int, default=None, help="Parallel chats per product (default: GEMINI_CONCURRENCY)")
+    parser.add_argument("--state", type=Path, default=Path("batch_state.jsonl"), help="Checkpoint file used to resume")
+    parser.add_argument("--report", type=Path, default=Path("batch_report.csv"), help="Per-product results/errors report")
+    parser.add_argument("--retry-failed", action="store_true", help="Re-run products that failed in a previous run")
+    parser.add_argument("--no-cache", action="store_true", help="Do not reuse previously generated shots")
+    parser.add_argument("--variants", action="store_true", help="Also write WebP/JPEG, thumbnail and marketplace variants")
+    parser.add_argument("--profile", default=None, help="Shot profile from shot_profiles.json (default: SHOT_PROFILE or 'full')")
+    args = parser.parse_args()
+
+    load_dotenv()
+    try:
+        profile = get_profile(args.profile)
+    except KeyError as e:
+        logger.error(e.args[0])
+        return
+    try:
+        products = discover_products(args.source)
+    except ValueError as e:
+        logger.error(e)
+        return
+    if not products:
+        logger.error(f"No product images found in {args.source}")
+        return
+
+    checkpoint = Checkpoint(args.state)
+    try:
+        asyncio.run(run_batch(
+            products, args.output, checkpoint,
+            concurrency=max(1, args.concurrency),
+            shot_concurrency=args.shot_concurrency,
+            retry_failed=args.retry_failed,
+            cache=None if args.no_cache else ResultCache(),
+            variants=args.variants,
+            profile=profile,
+        ))
+    finally:
+        write_report(args.report, products, checkpoint)
+        done = sum(1 for sku, _ in products if checkpoint.records.get(sku, {}).get("status") == "done")
+        logger.success(f"{done}/{len(products)} products done. Report written to {args.report}")
+
+if __name__ == "__main__":
+    main()
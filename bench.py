@@ -0,0 +1,279 @@
+"""Offline latency/throughput benchmark on top of the fake Gemini backend.
+
+Usage:
+    python bench.py                                   # server and batch paths at concurrency 1, 2, 4
+    python bench.py --mode server --concurrency 2 8 --jobs 32
+    python bench.py --send-latency 1 --failure-rate 0.1 --json bench.json
+
+Each run gets a fresh temporary working directory (queue, cache, uploads and
+outputs), so runs never see each other's results. The server path starts
+uvicorn as a subprocess and drives /upload + /status; the batch path runs
+batch.py over a generated catalog. Both report p50/p95/p99 job latency,
+images/minute and peak RSS of the process tree. Server runs also report the
+seconds until /ping answers (startup_s) and until /ready does (ready_s); a
+startup_s over --startup-budget fails the run.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+import httpx
+from loguru import logger
+from PIL import Image
+
+REPO_DIR = Path(__file__).resolve().parent
+BENCH_API_KEY = "bench_key"
+POLL_INTERVAL = 0.1
+# Seconds from launching uvicorn until the server answers; cold starts delay the first request
+STARTUP_BUDGET_SECONDS = float(os.getenv("STARTUP_BUDGET_SECONDS", "2.5"))
+
+def make_inputs(directory: Path, count: int, size: int):
+    """Distinct noise images, so no job is answered from the result cache."""
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = directory / f"product_{i:04d}.jpg"
+        Image.merge("RGB", [Image.effect_noise((size, size), 48 + i % 16) for _ in range(3)]).save(path, "JPEG", quality=85)
+        paths.append(path)
+    return paths
+
+def bench_env(args, workers: int) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": os.pathsep.join(filter(None, [str(REPO_DIR), env.get("PYTHONPATH")])),
+        "GEMINI_FAKE": "1",
+        "GEMINI_1PSID": "fake",
+        "GEMINI_1PSIDTS": "fake",
+        "MASTER_API_KEY": BENCH_API_KEY,
+        # One fake account, so its slot count is the number of concurrent jobs
+        "ACCOUNT_CONCURRENCY": str(workers),
+        "MAX_WORKERS": str(workers),
+        "GEMINI_FAKE_SEND_LATENCY": str(args.send_latency),
+        "GEMINI_FAKE_SAVE_LATENCY": str(args.save_latency),
+        "GEMINI_FAKE_FAILURE_RATE": str(args.failure_rate),
+        "GEMINI_FAKE_EMPTY_RATE": str(args.empty_rate),
+        "GEMINI_FAKE_IMAGE_SIZE": str(args.image_size),
+        "GEMINI_FAKE_IMAGES": str(args.images_per_shot),
+    })
+    # The governors' defaults are tuned for the real service and would dominate every
+    # number here; export GEMINI_SEND_RATE & co. to benchmark them deliberately
+    for name, value in (("GEMINI_SEND_RATE", "50"), ("GEMINI_SEND_RATE_MAX", "100"),
+                        ("GEMINI_SAVE_RATE", "100"), ("GEMINI_SAVE_RATE_MAX", "200"),
+                        ("GEMINI_RATE_BURST", "20"), ("GEMINI_RETRY_BASE_DELAY", "0.1")):
+        env.setdefault(name, value)
+    return env
+
+def tree_rss_mb(pid: int):
+    """Resident memory of a process and its descendants, from /proc (None elsewhere)."""
+    total = 0
+    pending = [pid]
+    try:
+        while pending:
+            current = pending.pop()
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+            for task in Path(f"/proc/{current}/task").iterdir():
+                children = (task / "children").read_text().split()
+                pending.extend(int(child) for child in children)
+    except (OSError, ValueError):
+        if total == 0:
+            return None
+    return round(total / 1024, 1)
+
+async def sample_rss(pid: int, peak: dict):
+    while True:
+        rss = tree_rss_mb(pid)
+        if rss is not None:
+            peak["rss_mb"] = max(peak.get("rss_mb", 0), rss)
+        await asyncio.sleep(0.2)
+
+def percentile(values, pct: float):
+    if not values:
+        return None
+    if len(values) == 1:
+        return round(values[0], 2)
+    return round(statistics.quantiles(values, n=100, method="inclusive")[int(pct) - 1], 2)
+
+def summarise(mode: str, concurrency: int, latencies, images: int, failures: int, wall: float, peak: dict, **extra) -> dict:
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "jobs": len(latencies) + failures,
+        "failures": failures,
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+        "p99_s": percentile(latencies, 99),
+        "images_per_min": round(images / wall * 60, 1) if wall else None,
+        "wall_s": round(wall, 2),
+        "peak_rss_mb": peak.get("rss_mb"),
+        **extra,
+    }
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+async def wait_until_up(base_url: str, process, started: float, path: str = "/ping", timeout: float = 60) -> float:
+    """Seconds from ``started`` until ``path`` answers 200."""
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() - started < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"Server exited with code {process.returncode}")
+            try:
+                if (await client.get(f"{base_url}{path}")).status_code == 200:
+                    return time.monotonic() - started
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.02)
+    raise RuntimeError(f"Server did not answer {path} within {timeout}s")
+
+async def run_job(client: httpx.AsyncClient, path: Path, timeout: float):
+    """Uploads one image and polls until the job finishes. Returns (seconds, images, ok)."""
+    started = time.monotonic()
+    with open(path, "rb") as f:
+        response = await client.post("/upload", files=[("files", (path.name, f.read(), "image/jpeg"))])
+    response.raise_for_status()
+    job_id = response.json()["job_id"]
+    while time.monotonic() - started < timeout:
+        status = (await client.get(f"/status/{job_id}")).json()
+        if status["status"] in ("completed", "failed"):
+            return time.monotonic() - started, len(status.get("results", [])), status["status"] == "completed"
+        await asyncio.sleep(POLL_INTERVAL)
+    return time.monotonic() - started, 0, False
+
+async def bench_server(args, concurrency: int, workdir: Path) -> dict:
+    inputs = make_inputs(workdir / "inputs", args.jobs, args.input_size)
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    log = open(workdir / "server.log", "w")
+    launched = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=workdir, env=bench_env(args, concurrency), stdout=log, stderr=subprocess.STDOUT,
+    )
+    peak = {}
+    sampler = asyncio.create_task(sample_rss(process.pid, peak))
+    try:
+        startup = await wait_until_up(base_url, process, launched)
+        ready = await wait_until_up(base_url, process, launched, "/ready")
+        queue = list(inputs)
+        outcomes = []
+
+        # One simulated client per worker, each submitting its next job when the last one finishes
+        async def client_loop(client):
+            while queue:
+                outcomes.append(await run_job(client, queue.pop(), args.timeout))
+
+        started = time.monotonic()
+        async with httpx.AsyncClient(base_url=base_url, headers={"X-API-Key": BENCH_API_KEY}, timeout=30) as client:
+            await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+        wall = time.monotonic() - started
+    finally:
+        sampler.cancel()
+        process.terminate()
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        log.close()
+
+    latencies = [seconds for seconds, _, ok in outcomes if ok]
+    images = sum(count for _, count, _ in outcomes)
+    failures = sum(1 for _, _, ok in outcomes if not ok)
+    return summarise("server", concurrency, latencies, images, failures, wall, peak,
+                     startup_s=round(startup, 2), ready_s=round(ready, 2))
+
+async def bench_batch(args, concurrency: int, workdir: Path) -> dict:
+    make_inputs(workdir / "catalog", args.jobs, args.input_size)
+    state_file = workdir / "batch_state.jsonl"
+    started = time.monotonic()
+    log = open(workdir / "batch.log", "w")
+    process = subprocess.Popen(
+        [sys.executable, str(REPO_DIR / "batch.py"), "catalog", "--concurrency", str(concurrency),
+         "--state", str(state_file), "--report", str(workdir / "batch_report.csv")],
+        cwd=workdir, env=bench_env(args, concurrency), stdout=log, stderr=subprocess.STDOUT,
+    )
+    peak = {}
+    sampler = asyncio.create_task(sample_rss(process.pid, peak))
+    try:
+        while process.poll() is None:
+            await asyncio.sleep(0.1)
+    finally:
+        sampler.cancel()
+        log.close()
+    wall = time.monotonic() - started
+
+    records = []
+    if state_file.exists():
+        records = [json.loads(line) for line in state_file.read_text().splitlines() if line.strip()]
+    latencies = [r["seconds"] for r in records if r["status"] == "done"]
+    images = sum(len(r.get("results", [])) for r in records)
+    failures = args.jobs - len(latencies)
+    return summarise("batch", concurrency, latencies, images, failures, wall, peak)
+
+def print_table(results):
+    columns = ["mode", "concurrency", "jobs", "failures", "p50_s", "p95_s", "p99_s", "images_per_min", "wall_s", "peak_rss_mb", "startup_s", "ready_s"]
+    rows = [[str(r.get(c, "")) if r.get(c) is not None else "-" for c in columns] for r in results]
+    widths = [max(len(c), *(len(row[i]) for row in rows)) for i, c in enumerate(columns)]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(v.ljust(w) for v, w in zip(row, widths)))
+
+async def run(args):
+    results = []
+    for mode in (["server", "batch"] if args.mode == "all" else [args.mode]):
+        for concurrency in args.concurrency:
+            workdir = Path(tempfile.mkdtemp(prefix=f"bench_{mode}_{concurrency}_"))
+            logger.info(f"Benchmarking {mode} path: {args.jobs} jobs at concurrency {concurrency} in {workdir}")
+            try:
+                bench = bench_server if mode == "server" else bench_batch
+                results.append(await bench(args, concurrency, workdir))
+            finally:
+                if not args.keep:
+                    shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the server and batch paths against a fake Gemini backend.")
+    parser.add_argument("--mode", choices=["server", "batch", "all"], default="all")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4], help="Workers / simulated clients per run")
+    parser.add_argument("--jobs", type=int, default=8, help="Product images per run")
+    parser.add_argument("--input-size", type=int, default=1200, help="Edge of the generated input images (px)")
+    parser.add_argument("--send-latency", type=float, default=0.3, help="Median send_message latency (s)")
+    parser.add_argument("--save-latency", type=float, default=0.05, help="Median image.save latency (s)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of send_message calls that raise")
+    parser.add_argument("--empty-rate", type=float, default=0.0, help="Fraction of shots returned without images")
+    parser.add_argument("--image-size", type=int, default=1024, help="Edge of the fake generated images (px)")
+    parser.add_argument("--images-per-shot", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=600, help="Give up on a server job after this many seconds")
+    parser.add_argument("--json", type=Path, help="Also write the results to this file")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary working directories")
+    parser.add_argument("--startup-budget", type=float, default=STARTUP_BUDGET_SECONDS,
+                        help="Fail if the server takes longer to answer /ping (s, 0 = no check)")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print_table(results)
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2))
+    failed = any(r["failures"] for r in results) and not args.failure_rate and not args.empty_rate
+    for r in results:
+        if args.startup_budget and r.get("startup_s") and r["startup_s"] > args.startup_budget:
+            logger.error(f"Server startup took {r['startup_s']}s, over the {args.startup_budget}s budget")
+            failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
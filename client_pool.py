@@ -0,0 +1,244 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from gemini_webapi.exceptions import AuthError, TemporarilyBlocked, UsageLimitExceeded
+from loguru import logger
+from img_service import GeminiImageGenerator
+from rate_limit import SEND_RATE, SEND_RATE_MAX, SEND_RATE_MIN, RateGovernor
+
+# Seconds an account sits out after throttling, and after its cookies expire
+# (a cookie sync for the account lifts the latter early)
+ACCOUNT_COOLDOWN_SECONDS = float(os.getenv("ACCOUNT_COOLDOWN_SECONDS", "600"))
+ACCOUNT_EXPIRED_COOLDOWN_SECONDS = float(os.getenv("ACCOUNT_EXPIRED_COOLDOWN_SECONDS", "3600"))
+# ... and after its client failed to start for another reason, so the next job tries another account
+ACCOUNT_INIT_COOLDOWN_SECONDS = float(os.getenv("ACCOUNT_INIT_COOLDOWN_SECONDS", "30"))
+# Weight of history in the per-account error rate (exponential moving average)
+ERROR_DECAY = 0.8
+
+def cooldown_for(error: Exception) -> float:
+    message = str(error).lower()
+    if isinstance(error, AuthError) or "expired" in message:
+        return ACCOUNT_EXPIRED_COOLDOWN_SECONDS
+    if isinstance(error, (UsageLimitExceeded, TemporarilyBlocked)) or "429" in message or "rate limit" in message:
+        return ACCOUNT_COOLDOWN_SECONDS
+    return 0
+
+class AccountUnavailable(Exception):
+    """The account picked for a job could not start a client; another account may."""
+
+class Account:
+    """One named credential set with its own client slots and send rate."""
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.credentials = {}
+        self.generation = 0
+        self.in_use = 0
+        self.error_rate = 0.0
+        self.cooldown_until = 0.0
+        self.slots = asyncio.Queue()
+        for _ in range(size):
+            self.slots.put_nowait(None)
+        # Quotas are per account, so each gets its own adaptive send governor
+        self.send_governor = RateGovernor(f"send_message[{name}]", SEND_RATE, SEND_RATE_MIN, SEND_RATE_MAX)
+
+    def has_credentials(self) -> bool:
+        return bool(self.credentials.get("GEMINI_1PSID") and self.credentials.get("GEMINI_1PSIDTS"))
+
+    def usable(self, now: float) -> bool:
+        return self.has_credentials() and now >= self.cooldown_until and not self.slots.empty()
+
+    def record(self, ok: bool):
+        self.error_rate = ERROR_DECAY * self.error_rate + (1 - ERROR_DECAY) * (0.0 if ok else 1.0)
+
+class ClientPool:
+    """Server-owned pool of initialised GeminiImageGenerator instances across accounts.
+
+    Each account has ``size`` slots holding either a ready generator or None
+    (initialised on next use). Jobs go to the usable account with the lowest
+    load plus recent error rate; throttled or expired accounts, and accounts
+    whose client fails to start, cool down.
+    Generators that fail during a job are closed and their slot reset, and
+    bumping an account's generation (after a cookie sync) retires its clients.
+    """
+
+    def __init__(self, size: int, account_loader, **generator_options):
+        self.size = max(1, size)
+        # Extra GeminiImageGenerator arguments, e.g. storage
+        self.generator_options = generator_options
+        self.accounts = {}
+        self._load_accounts = account_loader
+        self._changed = asyncio.Condition()
+        self.refresh_accounts()
+
+    def refresh_accounts(self):
+        """Re-reads the configured credential sets, adding any new accounts."""
+        configured = self._load_accounts()
+        for name, credentials in configured.items():
+            account = self.accounts.get(name)
+            if account is None:
+                account = self.accounts[name] = Account(name, self.size)
+            account.credentials = credentials
+        for name in set(self.accounts) - set(configured):
+            logger.info(f"Gemini account '{name}' removed from config")
+            del self.accounts[name]
+
+    async def _create(self, account: Account) -> GeminiImageGenerator:
+        generator = GeminiImageGenerator(
+            psid=account.credentials.get("GEMINI_1PSID"),
+            psidts=account.credentials.get("GEMINI_1PSIDTS"),
+            proxy=account.credentials.get("proxy"),
+            send_governor=account.send_governor,
+            **self.generator_options,
+        )
+        # Pooled clients stay open between jobs; auto_refresh keeps the cookies alive
+        await generator.init_client(auto_close=False)
+        generator.pool_generation = account.generation
+        generator.account = account.name
+        return generator
+
+    def _is_healthy(self, account: Account, generator) -> bool:
+        return (
+            generator is not None
+            and generator.client is not None
+            and generator.pool_generation == account.generation
+            and getattr(generator.client, "_running", True)
+        )
+
+    async def _discard(self, generator):
+        if generator is None:
+            return
+        try:
+            await generator.close()
+        except Exception as e:
+            logger.warning(f"Error closing pooled Gemini client: {e}")
+
+    async def _ensure(self, account: Account, generator) -> GeminiImageGenerator:
+        """Returns the slot's generator if healthy, otherwise a freshly initialised one."""
+        if self._is_healthy(account, generator):
+            return generator
+        await self._discard(generator)
+        return await self._create(account)
+
+    async def _warm_slot(self, account: Account):
+        generator = await account.slots.get()
+        try:
+            generator = await self._ensure(account, generator)
+        except Exception as e:
+            logger.error(f"Could not warm Gemini client for account '{account.name}': {e}")
+            self._penalise(account, e)
+            generator = None
+        account.slots.put_nowait(generator)
+        # A job may have queued for this slot while it was being warmed
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def warm(self, names=None):
+        """Initialises every slot up front so jobs do not pay the init latency."""
+        accounts = [a for a in self.accounts.values() if a.has_credentials() and (names is None or a.name in names)]
+        await asyncio.gather(*(self._warm_slot(a) for a in accounts for _ in range(self.size)))
+        logger.info(f"Gemini client pool warm: {self.ready_count()}/{self.size * len(self.accounts)} ready")
+
+    async def rebuild(self, name: str = None):
+        """Retires an account's clients (all accounts if ``name`` is None) and re-warms.
+
+        Used after new cookies were synced; it also lifts the account's cooldown.
+        """
+        self.refresh_accounts()
+        names = [name] if name else list(self.accounts)
+        for account_name in names:
+            account = self.accounts.get(account_name)
+            if account is None:
+                continue
+            account.generation += 1
+            account.cooldown_until = 0.0
+            account.error_rate = 0.0
+            logger.info(f"Rebuilding Gemini clients for account '{account_name}' (generation {account.generation})")
+        async with self._changed:
+            self._changed.notify_all()
+        await self.warm(names)
+
+    def ready_count(self) -> int:
+        return sum(
+            1 for account in self.accounts.values()
+            for generator in account.slots._queue if self._is_healthy(account, generator)
+        )
+
+    def _pick(self):
+        now = time.monotonic()
+        candidates = [a for a in self.accounts.values() if a.usable(now)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda a: (a.in_use / self.size + a.error_rate, a.in_use))
+
+    def report(self, generator, error: Exception):
+        """Counts a failure the job handled itself (e.g. failed shots) against the generator's account."""
+        generator.job_failures += 1
+        account = self.accounts.get(generator.account)
+        if account is not None:
+            self._penalise(account, error)
+
+    def _penalise(self, account: Account, error: Exception, min_cooldown: float = 0):
+        account.record(ok=False)
+        cooldown = max(cooldown_for(error), min_cooldown)
+        if cooldown:
+            account.cooldown_until = time.monotonic() + cooldown
+            logger.warning(f"Gemini account '{account.name}' cooling down for {cooldown:.0f}s: {error}")
+
+    async def _checkout(self) -> Account:
+        async with self._changed:
+            while (account := self._pick()) is None:
+                # Wake up when a slot frees, config changes, or the next cooldown ends
+                now = time.monotonic()
+                pending = [a.cooldown_until - now for a in self.accounts.values() if a.cooldown_until > now]
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout=min(pending) if pending else None)
+                except asyncio.TimeoutError:
+                    pass
+            account.in_use += 1
+            return account
+
+    async def _checkin(self, account: Account, generator):
+        account.slots.put_nowait(generator)
+        account.in_use -= 1
+        async with self._changed:
+            self._changed.notify_all()
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Borrows a healthy generator from the best account; it is recycled if the caller raises."""
+        account = await self._checkout()
+        generator = account.slots.get_nowait()
+        try:
+            generator = await self._ensure(account, generator)
+        except BaseException as e:
+            await self._checkin(account, None)
+            if not isinstance(e, Exception):
+                raise
+            self._penalise(account, e, ACCOUNT_INIT_COOLDOWN_SECONDS)
+            raise AccountUnavailable(f"Gemini account '{account.name}' could not start a client: {e}") from e
+
+        generator.job_failures = 0
+        try:
+            yield generator
+        except BaseException as e:
+            if isinstance(e, Exception):
+                logger.warning(f"Recycling Gemini client of account '{account.name}' after a failed job")
+                self._penalise(account, e)
+            await self._discard(generator)
+            await self._checkin(account, None)
+            raise
+
+        if not generator.job_failures:
+            account.record(ok=True)
+        if not self._is_healthy(account, generator):
+            # Cookies were rotated while the job ran
+            await self._discard(generator)
+            generator = None
+        await self._checkin(account, generator)
+
+    async def close(self):
+        for account in self.accounts.values():
+            while not account.slots.empty():
+                await self._discard(account.slots.get_nowait())
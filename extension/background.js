@@ -17,7 +17,7 @@ chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
 });
 
 async function syncCookies() {
-    const settings = await chrome.storage.local.get(["serverUrl", "apiKey"]);
+    const settings = await chrome.storage.local.get(["serverUrl", "apiKey", "account"]);
     if (!settings.serverUrl || !settings.apiKey) {
         console.log("Probaho Sync: Settings not configured.");
         return;
@@ -38,7 +38,7 @@ async function syncCookies() {
                     "Content-Type": "application/json",
                     "X-API-Key": settings.apiKey
                 },
-                body: JSON.stringify({ psid, psidts })
+                body: JSON.stringify({ psid, psidts, account: settings.account || "default" })
             });
             const data = await response.json();
             console.log("Probaho Sync:", data.message);
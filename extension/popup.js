@@ -1,8 +1,9 @@
 document.getElementById('save').addEventListener('click', async () => {
     const serverUrl = document.getElementById('serverUrl').value.replace(/\/$/, "");
     const apiKey = document.getElementById('apiKey').value;
+    const account = document.getElementById('account').value.trim();
 
-    await chrome.storage.local.set({ serverUrl, apiKey });
+    await chrome.storage.local.set({ serverUrl, apiKey, account });
 
     const status = document.getElementById('status');
     status.textContent = "Saving and syncing...";
@@ -18,7 +19,8 @@ document.getElementById('save').addEventListener('click', async () => {
 });
 
 // Load existing settings
-chrome.storage.local.get(['serverUrl', 'apiKey'], (data) => {
+chrome.storage.local.get(['serverUrl', 'apiKey', 'account'], (data) => {
     if (data.serverUrl) document.getElementById('serverUrl').value = data.serverUrl;
     if (data.apiKey) document.getElementById('apiKey').value = data.apiKey;
+    if (data.account) document.getElementById('account').value = data.account;
 });
@@ -0,0 +1,101 @@
+"""Offline stand-in for gemini_webapi.GeminiClient, used by benchmarks and local runs.
+
+Enable it with GEMINI_FAKE=1; img_service then builds FakeGeminiClient instead
+of the real client. Latency follows a log-normal distribution around the
+configured median (sigma 0 gives a constant delay). Failures raise
+gemini_webapi's APIError, so the retry and account-penalty paths run just as
+they do against the real service.
+"""
+import asyncio
+import io
+import os
+import random
+from pathlib import Path
+from gemini_webapi.exceptions import APIError
+from PIL import Image
+
+GEMINI_FAKE = os.getenv("GEMINI_FAKE", "false").lower() in ("1", "true", "yes")
+# Median seconds per call; sigma is the spread of the log-normal distribution
+FAKE_INIT_LATENCY = float(os.getenv("GEMINI_FAKE_INIT_LATENCY", "0.5"))
+FAKE_SEND_LATENCY = float(os.getenv("GEMINI_FAKE_SEND_LATENCY", "2"))
+FAKE_SAVE_LATENCY = float(os.getenv("GEMINI_FAKE_SAVE_LATENCY", "0.2"))
+FAKE_LATENCY_SIGMA = float(os.getenv("GEMINI_FAKE_LATENCY_SIGMA", "0.3"))
+# Fraction of send_message calls that raise / come back without images
+FAKE_FAILURE_RATE = float(os.getenv("GEMINI_FAKE_FAILURE_RATE", "0"))
+FAKE_EMPTY_RATE = float(os.getenv("GEMINI_FAKE_EMPTY_RATE", "0"))
+FAKE_IMAGES_PER_SHOT = int(os.getenv("GEMINI_FAKE_IMAGES", "1"))
+FAKE_IMAGE_SIZE = int(os.getenv("GEMINI_FAKE_IMAGE_SIZE", "1024"))
+
+# Encoded PNGs by edge size, so saving does not re-render noise every time
+_png_cache = {}
+
+def sample_latency(median: float, sigma: float = FAKE_LATENCY_SIGMA) -> float:
+    if median <= 0:
+        return 0
+    return median * random.lognormvariate(0, sigma) if sigma > 0 else median
+
+def _render_png(size: int) -> bytes:
+    if size not in _png_cache:
+        # Noise compresses about as badly as a real photo, so file sizes stay realistic
+        image = Image.merge("RGB", [Image.effect_noise((size, size), 64) for _ in range(3)])
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG")
+        _png_cache[size] = buffer.getvalue()
+    return _png_cache[size]
+
+class FakeImage:
+    def __init__(self, size: int = FAKE_IMAGE_SIZE, save_latency: float = FAKE_SAVE_LATENCY):
+        self.size = size
+        self.save_latency = save_latency
+        self.url = f"https://fake.invalid/{random.getrandbits(64):016x}.png"
+
+    async def save(self, path: str = "temp", filename: str = None, skip_invalid_filename: bool = False, **kwargs):
+        await asyncio.sleep(sample_latency(self.save_latency))
+        target = Path(path) / (filename or self.url.rsplit("/", 1)[-1])
+        target.parent.mkdir(parents=True, exist_ok=True)
+        data = await asyncio.to_thread(_render_png, self.size)
+        await asyncio.to_thread(target.write_bytes, data)
+        return str(target)
+
+class FakeResponse:
+    def __init__(self, text: str, images):
+        self.text = text
+        self.images = images
+
+class FakeChat:
+    def __init__(self, client):
+        self.client = client
+        self.history = []
+
+    async def send_message(self, prompt: str, files=None, **kwargs):
+        client = self.client
+        await asyncio.sleep(sample_latency(client.send_latency))
+        self.history.append(prompt)
+        if random.random() < client.failure_rate:
+            raise APIError("Fake Gemini: simulated upstream failure")
+        if files or random.random() < client.empty_rate:
+            return FakeResponse("Understood. Send the shot you want.", [])
+        return FakeResponse("Here is your image.", [FakeImage(client.image_size) for _ in range(client.images_per_shot)])
+
+class FakeGeminiClient:
+    """Implements the slice of GeminiClient that img_service uses."""
+
+    def __init__(self, secure_1psid: str = None, secure_1psidts: str = None, proxy: str = None, **kwargs):
+        self.proxy = proxy
+        self.init_latency = FAKE_INIT_LATENCY
+        self.send_latency = FAKE_SEND_LATENCY
+        self.failure_rate = FAKE_FAILURE_RATE
+        self.empty_rate = FAKE_EMPTY_RATE
+        self.images_per_shot = FAKE_IMAGES_PER_SHOT
+        self.image_size = FAKE_IMAGE_SIZE
+        self._running = False
+
+    async def init(self, timeout: float = 30, auto_close: bool = False, close_delay: float = 300, auto_refresh: bool = True, **kwargs):
+        await asyncio.sleep(sample_latency(self.init_latency))
+        self._running = True
+
+    async def close(self, delay: float = 0):
+        self._running = False
+
+    def start_chat(self, **kwargs):
+        return FakeChat(self)
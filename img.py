@@ -4,42 +4,21 @@ import sys
 from pathlib import Path
 from gemini_webapi import GeminiClient
 from loguru import logger
+# Style prompt and shot list are shared with the server
+from shot_profiles import SHOT_LIST, STYLE_PROMPT
 
 # --- Configuration ---
 # Cookies: Get these from gemini.google.com > F12 > Network > Cookies
-SECURE_1PSID = os.getenv("GEMINI_1PSID", "g.a0006ghXtGBRisMqgMH-aJTJwh-5buz9s7O3Uv_X9FJkpP3AreZzzRYNWiFLqVuL504QNlDQDAACgYKAcYSARUSFQHGX2MiTkh7BcVVJZYqYP-EPjlidRoVAUF8yKpRU01UfgilbUw13g0wgyr80076")
-SECURE_1PSIDTS = os.getenv("GEMINI_1PSIDTS", "sidts-CjIB7I_69PNjXMBEM0K4TFDgxnQavMYQaJJXTrEnoJDDdgLoQUZeHXMPAc8gQq7ntFVg3BAA")
+SECURE_1PSID = os.getenv("GEMINI_1PSID")
+SECURE_1PSIDTS = os.getenv("GEMINI_1PSIDTS")
 
 # Paths
 INPUT_PRODUCT_IMAGE = "input/my_product.jpg"  # The reference photo
 OUTPUT_DIR = Path("output_product_set")
 
-# --- The Master Style Prompt (Based on your requirements) ---
-STYLE_PROMPT = """
-STYLE GUIDELINES:
-1. Lighting: Soft, diffused studio lighting mimicking natural daylight. Balanced highlights, gentle shadows, no harsh reflections.
-2. Background: Pure white (#FFFFFF) seamless background. Minimal and clean.
-3. Product Focus: Perfectly sharp, centered, realistic geometry. No props.
-4. Color: Accurate white balance, no oversaturation.
-5. Quality: Ultra-high resolution, commercial-grade clarity, Amazon/Shopify ready.
-6. Retouching: Remove dust/imperfections but keep authentic texture.
-7. Shadow: Add a subtle, natural drop shadow for grounding.
-"""
-
-# --- The Shot List ---
-# The script will generate a set for EACH of these angles.
-SHOT_LIST = [
-    ("Front_View", "Generate a Front view of this product."),
-    ("Back_View", "Generate a Back view of this product."),
-    ("Side_View", "Generate a Side view of this product."),
-    ("Three_Quarter", "Generate a 45-degree three-quarter angle view of this product."),
-    ("Detail_Shot", "Generate a Close-up detail shot highlighting texture and material."),
-    ("Lifestyle", "Generate a lifestyle image showing the product in realistic use on a table.")
-]
-
 async def get_client():
     """Authenticates the Gemini Client."""
-    if "YOUR_COOKIE" in SECURE_1PSID:
+    if not SECURE_1PSID or not SECURE_1PSIDTS:
         logger.error("Please set your GEMINI_1PSID and GEMINI_1PSIDTS environment variables.")
         sys.exit(1)
 
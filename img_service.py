@@ -1,9 +1,18 @@
 import asyncio
+import hashlib
 import os
 from pathlib import Path
 from dotenv import load_dotenv
 from gemini_webapi import GeminiClient
+from gemini_webapi.exceptions import AuthError, TemporarilyBlocked, UsageLimitExceeded
 from loguru import logger
+from fake_gemini import GEMINI_FAKE, FakeGeminiClient
+from metrics import CACHE_LOOKUPS, stage
+from preprocess import REFERENCE_PREPROCESS, prepare_reference
+from rate_limit import call_with_retry, save_governor
+from rate_limit import send_governor as send_governor_default
+from result_cache import file_digest, shot_key
+from shot_profiles import REFERENCE_PROMPT, ShotProfile, build_shot_prompt, default_profile
 
 # Load .env file
 load_dotenv()
@@ -12,43 +21,62 @@ load_dotenv()
 SECURE_1PSID = os.getenv("GEMINI_1PSID") or os.getenv("1PSID") or os.getenv("SECURE_1PSID")
 SECURE_1PSIDTS = os.getenv("GEMINI_1PSIDTS") or os.getenv("1PSIDTS") or os.getenv("SECURE_1PSIDTS")
 GEMINI_PROXY = os.getenv("GEMINI_PROXY")
+# Number of shots generated at once, each in its own chat session (1 = one sequential chat)
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "1"))
 
-STYLE_PROMPT = """
-STYLE GUIDELINES:
-1. Lighting: Soft, diffused studio lighting mimicking natural daylight. Balanced highlights, gentle shadows, no harsh reflections.
-2. Background: Pure white (#FFFFFF) seamless background. Minimal and clean.
-3. Product Focus: Perfectly sharp, centered, realistic geometry. No props.
-4. Color: Accurate white balance, no oversaturation.
-5. Quality: Ultra-high resolution, commercial-grade clarity, Amazon/Shopify ready.
-6. Retouching: Remove dust/imperfections but keep authentic texture.
-7. Shadow: Add a subtle, natural drop shadow for grounding.
-"""
-
-SHOT_LIST = [
-    ("Front_View", "Generate a Front view of this product."),
-    ("Back_View", "Generate a Back view of this product."),
-    ("Side_View", "Generate a Side view of this product."),
-    ("Three_Quarter", "Generate a 45-degree three-quarter angle view of this product."),
-    ("Detail_Shot", "Generate a Close-up detail shot highlighting texture and material."),
-    ("Lifestyle", "Generate a lifestyle image showing the product in realistic use on a table.")
-]
+def is_retryable(error: Exception) -> bool:
+    """Expired or invalid cookies will not fix themselves on retry."""
+    return not isinstance(error, AuthError)
+
+def is_account_error(error: Exception) -> bool:
+    """Throttling or expired cookies: every other shot on the same account would fail too."""
+    message = str(error).lower()
+    return (
+        isinstance(error, (AuthError, UsageLimitExceeded, TemporarilyBlocked))
+        or "429" in message or "rate limit" in message or "expired" in message
+    )
+
+def output_filename(input_image_path: Path, shot_name: str, shot_prompt: str, index: int) -> str:
+    """Name of a generated image; the prompt digest keeps other profiles and styles from overwriting it."""
+    prompt_tag = hashlib.sha256(shot_prompt.encode()).hexdigest()[:8]
+    return f"{input_image_path.stem}_{shot_name}_{prompt_tag}_v{index}.png"
+
+class ShotsFailed(Exception):
+    """Some shots failed while the others were saved.
+
+    ``results`` holds the saved paths and ``errors`` maps shot name to error.
+    """
+
+    def __init__(self, results, errors):
+        self.results = results
+        self.errors = errors
+        super().__init__(f"{len(errors)} shot(s) failed: " + "; ".join(f"{shot}: {e}" for shot, e in errors.items()))
 
 class GeminiImageGenerator:
-    def __init__(self, psid=None, psidts=None, proxy=None):
+    def __init__(self, psid=None, psidts=None, proxy=None, concurrency=None, send_governor=None, preprocess=None, storage=None):
         self.psid = psid or SECURE_1PSID
         self.psidts = psidts or SECURE_1PSIDTS
         self.proxy = proxy or GEMINI_PROXY
+        self.concurrency = max(1, concurrency or GEMINI_CONCURRENCY)
+        # Defaults to the process-wide governor; the client pool passes one per account
+        self.send_governor = send_governor or send_governor_default
+        self.preprocess = REFERENCE_PREPROCESS if preprocess is None else preprocess
+        # Saved images are published here (see storage.py); None leaves them on local disk only
+        self.storage = storage
         self.client = None
 
-    async def init_client(self):
+    async def init_client(self, auto_close=True):
         if not self.psid or not self.psidts:
             logger.error("Missing cookies: GEMINI_1PSID or GEMINI_1PSIDTS not provided.")
             raise ValueError("GEMINI_1PSID and GEMINI_1PSIDTS must be set.")
         
-        logger.info(f"Initializing GeminiClient with Proxy: {self.proxy if self.proxy else 'None'}")
+        # GEMINI_FAKE swaps in the offline stand-in used for benchmarks
+        client_class = FakeGeminiClient if GEMINI_FAKE else GeminiClient
+        logger.info(f"Initializing {client_class.__name__} with Proxy: {self.proxy if self.proxy else 'None'}")
         try:
-            self.client = GeminiClient(self.psid, self.psidts, proxy=self.proxy)
-            await self.client.init(timeout=60, auto_close=True, close_delay=300, auto_refresh=True)
+            with stage("client_init"):
+                self.client = client_class(self.psid, self.psidts, proxy=self.proxy)
+                await self.client.init(timeout=60, auto_close=auto_close, close_delay=300, auto_refresh=True)
             logger.success("GeminiClient initialized successfully.")
             return self.client
         except Exception as e:
@@ -57,77 +85,219 @@ class GeminiImageGenerator:
                 logger.warning("Cookie expiration detected. Please refresh Gemini in your browser and sync.")
             raise e
 
-    async def generate_for_image(self, input_image_path: Path, output_dir: Path, progress_callback=None):
-        """Generates all shots for a single input image."""
-        if not self.client:
-            await self.init_client()
+    async def close(self):
+        if self.client:
+            await self.client.close()
+            self.client = None
 
-        output_dir.mkdir(parents=True, exist_ok=True)
-        
-        try:
-            chat = self.client.start_chat()
-            
-            if progress_callback:
-                await progress_callback({"status": "uploading", "message": f"Uploading reference: {input_image_path.name}"})
-
-            # Initial handshake: Upload the reference image ONCE
-            if progress_callback:
-                await progress_callback({"status": "uploading", "message": "Analyzing reference product image..."})
-
-            response = await chat.send_message(
-                "You are a professional e-commerce product photographer/AI. "
-                "I am uploading ONE reference image of a product. Your job is to generate variations of THIS EXACT product from different angles. "
-                "CRITICAL: Maintain the exact geometry, branding, and materials of the product in the image. Do NOT invent a new product.",
-                files=[input_image_path]
+    async def _send_reference(self, chat, reference_path: Path):
+        """Initial handshake: upload the reference image into the chat."""
+        with stage("reference_upload"):
+            return await call_with_retry(
+                self.send_governor,
+                lambda: chat.send_message(REFERENCE_PROMPT, files=[reference_path]),
+                f"Reference upload for {reference_path.name}",
+                retry_if=is_retryable,
             )
-            
-            generated_files = []
 
-            for shot_name, shot_instruction in SHOT_LIST:
+    async def _generate_shot(self, chat, input_image_path: Path, output_dir: Path, shot_name, shot_prompt, progress_callback=None, cache=None, cache_key=None, max_variants=None):
+        """Requests one shot in an already primed chat and saves the returned images.
+
+        Only the first ``max_variants`` images are downloaded (all if None). Shots
+        whose images all saved are recorded in ``cache`` under ``cache_key``.
+        """
+        if progress_callback:
+            await progress_callback({"status": "generating", "shot": shot_name, "message": f"Generating {shot_name} angle..."})
+
+        # An empty image list usually means throttling, so it backs off like an error
+        with stage("shot", shot=shot_name) as timing:
+            response = await call_with_retry(
+                self.send_governor,
+                lambda: chat.send_message(shot_prompt),
+                f"{shot_name} for {input_image_path.name}",
+                is_empty=lambda r: not r.images,
+                retry_if=is_retryable,
+            )
+            if not response.images:
+                timing["outcome"] = "empty"
+
+        images = response.images[:max_variants] if max_variants else response.images
+        generated_files = []
+        if images:
+            for i, image in enumerate(images):
+                filename = output_filename(input_image_path, shot_name, shot_prompt, i + 1)
+
+                # Retried with backoff; a CDN that is not ready yet looks like a transient failure
+                try:
+                    with stage("image_save", shot=shot_name):
+                        await call_with_retry(
+                            save_governor,
+                            lambda: image.save(path=str(output_dir), filename=filename, skip_invalid_filename=True),
+                            f"Saving {filename}",
+                        )
+                except Exception as e:
+                    logger.error(f"Failed to download/save {filename} after attempts: {e}")
+                    # We don't want to crash the whole job if one image fails to download
+                    # but we log it clearly.
+                    continue
+
+                generated_files.append(str(output_dir / filename))
+                logger.success(f"Saved: {filename}")
+                if self.storage is not None:
+                    try:
+                        await self.storage.publish(output_dir / filename)
+                    except Exception as e:
+                        # The local copy is still served; GC will not track it
+                        logger.error(f"Could not publish {filename} to storage: {e}")
                 if progress_callback:
-                    await progress_callback({"status": "generating", "shot": shot_name, "message": f"Generating {shot_name} angle..."})
-
-                # Stricter prompt referring to the initial context
-                full_prompt = (
-                    f"Task: Generate the '{shot_name}' variant.\n"
-                    f"Instruction: {shot_instruction}\n"
-                    f"Reference: Use the product from the uploaded image ONLY.\n\n"
-                    f"{STYLE_PROMPT}\n"
-                    f"IMPORTANT: The generated output MUST be an image of the exact same product as shown in our first message."
+                    await progress_callback({"status": "saved", "shot": shot_name, "path": str(output_dir / filename), "message": f"Saved {filename}"})
+        else:
+            logger.warning(f"Gemini returned no images for {shot_name}. Text response: {response.text[:100]}...")
+            raise RuntimeError(f"Gemini returned no images for {shot_name}")
+        if not generated_files:
+            raise RuntimeError(f"None of the {shot_name} images could be saved")
+
+        if cache is not None and cache_key and generated_files and len(generated_files) == len(images):
+            # SQLite writes and eviction stay off the event loop
+            await asyncio.to_thread(cache.put, cache_key, generated_files)
+
+        if progress_callback:
+            await progress_callback({"status": "shot_done", "shot": shot_name, "files": generated_files, "message": f"{shot_name} done"})
+
+        return generated_files
+
+    async def _shot_failed(self, shot_name, error, errors, progress_callback=None):
+        """Records a failed shot, or re-raises errors that would fail every other shot too.
+
+        Account errors go up to the client pool, which cools the account down and recycles the client.
+        """
+        if not is_retryable(error) or is_account_error(error):
+            raise error
+        logger.error(f"{shot_name} failed: {error}")
+        errors[shot_name] = error
+        if progress_callback:
+            await progress_callback({"status": "shot_failed", "shot": shot_name, "error": str(error), "message": f"{shot_name} failed"})
+
+    async def _generate_sequential(self, input_image_path: Path, reference_path: Path, output_dir: Path, shots, progress_callback=None, cache=None, max_variants=None):
+        """Shots in one chat, one after another. Returns ({shot_name: files}, {shot_name: error})."""
+        chat = self.client.start_chat()
+        await self._send_reference(chat, reference_path)
+
+        generated, errors = {}, {}
+        for shot_name, shot_prompt, cache_key in shots:
+            try:
+                generated[shot_name] = await self._generate_shot(
+                    chat, input_image_path, output_dir, shot_name, shot_prompt, progress_callback, cache, cache_key, max_variants
                 )
+            except Exception as e:
+                await self._shot_failed(shot_name, e, errors, progress_callback)
+
+        return generated, errors
+
+    async def _generate_parallel(self, input_image_path: Path, reference_path: Path, output_dir: Path, shots, concurrency: int, progress_callback=None, cache=None, max_variants=None):
+        """Fans the shots out over independent chats, each primed with the reference image.
+
+        Returns ({shot_name: files}, {shot_name: error}).
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        generated, errors = {}, {}
+
+        async def run_shot(shot_name, shot_prompt, cache_key):
+            async with semaphore:
+                try:
+                    chat = self.client.start_chat()
+                    await self._send_reference(chat, reference_path)
+                    generated[shot_name] = await self._generate_shot(
+                        chat, input_image_path, output_dir, shot_name, shot_prompt, progress_callback, cache, cache_key, max_variants
+                    )
+                except Exception as e:
+                    await self._shot_failed(shot_name, e, errors, progress_callback)
+
+        tasks = [asyncio.create_task(run_shot(*shot)) for shot in shots]
+        try:
+            await asyncio.gather(*tasks)
+        except Exception:
+            for task in tasks:
+                task.cancel()
+            raise
+
+        return generated, errors
+
+    async def generate_for_image(self, input_image_path: Path, output_dir: Path, progress_callback=None, concurrency=None, cache=None, bypass_cache=False, shots=None, profile: ShotProfile = None):
+        """Generates the shots of ``profile`` (or only the ``shots`` named) for a single input image.
+
+        The profile (see shot_profiles) picks the shots, their style and how many
+        variants of each are kept; it defaults to every shot in the studio style.
+
+        A failing shot does not stop the others: once every shot was attempted,
+        ShotsFailed is raised carrying the saved paths and the per-shot errors.
+        Errors no retry can fix (expired cookies) are raised straight away.
+
+        With ``concurrency`` > 1 the shots run in that many parallel chat sessions.
+        With a ``cache`` (see result_cache.ResultCache), shots already generated for
+        the same image bytes and prompts are returned from disk and only the missing
+        ones are sent upstream; ``bypass_cache`` forces regeneration.
+        """
+        output_dir.mkdir(parents=True, exist_ok=True)
+        concurrency = max(1, concurrency or self.concurrency)
+        profile = profile or default_profile()
+        shot_list = [(name, instruction) for name, instruction in profile.shots if shots is None or name in shots]
+
+        try:
+            results = {}
+            errors = {}
+            pending = []
+            image_digest = None
+            if cache is not None or self.preprocess:
+                # Uploads run to MAX_UPLOAD_MB; hash them off the event loop
+                image_digest = await asyncio.to_thread(file_digest, input_image_path)
+            for shot_name, shot_instruction in shot_list:
+                shot_prompt = build_shot_prompt(shot_name, shot_instruction, profile.style)
+                cache_key = None
+                if cache is not None:
+                    # A variant limit is part of the key so a trimmed set never stands in for a full one
+                    limit = [f"max_variants={profile.max_variants}"] if profile.max_variants else []
+                    cache_key = shot_key(image_digest, REFERENCE_PROMPT, shot_prompt, *limit)
+                    cached = None if bypass_cache else cache.get(cache_key)
+                    CACHE_LOOKUPS.inc(result="bypass" if bypass_cache else "hit" if cached else "miss")
+                    if cached:
+                        logger.info(f"Cache hit for {input_image_path.name} / {shot_name}")
+                        results[shot_name] = cached
+                        if progress_callback:
+                            await progress_callback({"status": "cached", "shot": shot_name, "files": cached, "message": f"{shot_name} loaded from cache"})
+                        continue
+                pending.append((shot_name, shot_prompt, cache_key))
+
+            if pending:
+                if not self.client:
+                    await self.init_client()
+
+                # Upload a downscaled, upright copy; outputs are still named after the original
+                reference_path = input_image_path
+                if self.preprocess:
+                    reference_path = await prepare_reference(input_image_path, image_digest)
+
+                if progress_callback:
+                    await progress_callback({"status": "uploading", "message": f"Uploading reference: {input_image_path.name}"})
+
+                if progress_callback:
+                    await progress_callback({"status": "uploading", "message": "Analyzing reference product image..."})
 
-                response = await chat.send_message(full_prompt)
-
-                if response.images:
-                    for i, image in enumerate(response.images):
-                        filename = f"{input_image_path.stem}_{shot_name}_v{i+1}.png"
-                        
-                        # Retry logic for saving (mitigates transient network/timeout issues)
-                        max_retries = 3
-                        for attempt in range(max_retries):
-                            try:
-                                # We add a small delay before saving to ensure Google's CDN is ready
-                                await asyncio.sleep(2)
-                                await image.save(path=str(output_dir), filename=filename, skip_invalid_filename=True)
-                                generated_files.append(str(output_dir / filename))
-                                logger.success(f"Saved: {filename}")
-                                break
-                            except Exception as e:
-                                if attempt == max_retries - 1:
-                                    logger.error(f"Failed to download/save {filename} after attempts: {e}")
-                                    # We don't want to crash the whole job if one image fails to download
-                                    # but we log it clearly.
-                                    break
-                                logger.warning(f"Save attempt {attempt + 1} failed for {filename}. Retrying...")
-                                await asyncio.sleep(3)
+                if concurrency > 1:
+                    generated, errors = await self._generate_parallel(input_image_path, reference_path, output_dir, pending, concurrency, progress_callback, cache, profile.max_variants)
                 else:
-                    logger.warning(f"Gemini returned no images for {shot_name}. Text response: {response.text[:100]}...")
-                
-                # Small pause between messages
-                await asyncio.sleep(3)
+                    generated, errors = await self._generate_sequential(input_image_path, reference_path, output_dir, pending, progress_callback, cache, profile.max_variants)
+                results.update(generated)
 
-            return generated_files
+            # Flatten in profile order so ordering is the same however shots were produced
+            saved = [path for shot_name, _ in shot_list for path in results.get(shot_name, [])]
+            if errors:
+                raise ShotsFailed(saved, errors)
+            return saved
 
+        except ShotsFailed:
+            raise
         except Exception as e:
             logger.exception(f"Error generating shots for {input_image_path}: {e}")
             raise e
@@ -0,0 +1,101 @@
+import hashlib
+import os
+import re
+import uuid
+from pathlib import Path
+import aiofiles
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+from loguru import logger
+
+MAX_UPLOAD_MB = float(os.getenv("MAX_UPLOAD_MB", "25"))
+MAX_REQUEST_MB = float(os.getenv("MAX_REQUEST_MB", "200"))
+CHUNK_SIZE = 1024 * 1024
+
+class UploadTooLarge(Exception):
+    pass
+
+class RequestSizeLimit:
+    """ASGI middleware refusing request bodies over ``max_mb`` before they are parsed.
+
+    Form parsing spools every file to disk before the endpoint runs, so the caps
+    in store_uploads alone would only apply once the whole body had arrived. A
+    Content-Length over the cap is answered with 413 without reading the body;
+    a body sent without one is counted as it arrives and cut off at the cap.
+    """
+
+    def __init__(self, app, max_mb: float = MAX_REQUEST_MB):
+        self.app = app
+        self.max_mb = max_mb
+        self.max_bytes = int(max_mb * 1024 * 1024)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        detail = f"Request exceeds {self.max_mb:g} MB"
+        length = dict(scope["headers"]).get(b"content-length", b"")
+        if length.isdigit() and int(length) > self.max_bytes:
+            response = JSONResponse({"detail": detail}, status_code=413, headers={"Connection": "close"})
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+def _safe_suffix(filename: str) -> str:
+    suffix = Path(filename or "").suffix.lower()
+    return suffix if re.fullmatch(r"\.[a-z0-9]{1,5}", suffix) else ".jpg"
+
+async def store_upload(file: UploadFile, upload_dir: Path, max_bytes: int):
+    """Streams an upload to disk under its content hash.
+
+    Chunks are hashed as they arrive and written with aiofiles so the event loop
+    never blocks on disk. Identical content lands on the same path, so it is
+    only kept once and concurrent jobs can never overwrite each other's inputs.
+    Returns (path, size). Raises UploadTooLarge past ``max_bytes``.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    part_path = upload_dir / f".{uuid.uuid4().hex}.part"
+
+    try:
+        async with aiofiles.open(part_path, "wb") as out:
+            while chunk := await file.read(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"{file.filename} exceeds the upload size limit")
+                digest.update(chunk)
+                await out.write(chunk)
+
+        final_path = upload_dir / f"{digest.hexdigest()[:32]}{_safe_suffix(file.filename)}"
+        if final_path.exists():
+            logger.info(f"Upload {file.filename} already stored as {final_path.name}")
+            # Marks it as recently used, so cleanup of a finished job sharing it leaves it alone
+            os.utime(final_path)
+        else:
+            os.replace(part_path, final_path)
+        return final_path, size
+    finally:
+        part_path.unlink(missing_ok=True)
+
+async def store_uploads(files, upload_dir: Path, max_file_mb: float = MAX_UPLOAD_MB, max_request_mb: float = MAX_REQUEST_MB):
+    """Stores every file of a request, enforcing per-file and per-request caps."""
+    max_file = int(max_file_mb * 1024 * 1024)
+    remaining = int(max_request_mb * 1024 * 1024)
+    stored = []
+    for file in files:
+        if remaining <= 0:
+            raise UploadTooLarge(f"Request exceeds {max_request_mb:g} MB")
+        path, size = await store_upload(file, upload_dir, min(max_file, remaining))
+        remaining -= size
+        stored.append(path)
+    return stored
@@ -0,0 +1,451 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+from loguru import logger
+
+QUEUE_DB = Path(os.getenv("QUEUE_DB", "jobs.db"))
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", "100"))
+# "local": SQLite queue and in-process events (one host); "redis": shared by API and worker processes on any node
+JOB_BACKEND = os.getenv("JOB_BACKEND", "local").lower()
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "probaho:")
+# Idle workers also re-check the queue this often, for jobs enqueued by other processes
+QUEUE_POLL_SECONDS = float(os.getenv("QUEUE_POLL_SECONDS", "1"))
+# A processing job not renewed for this long belongs to a dead worker and is requeued
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "120"))
+# Finished jobs are kept this long (Redis expires them, SQLite prunes them in prune())
+JOB_RETENTION_DAYS = float(os.getenv("JOB_RETENTION_DAYS", "7"))
+ACTIVE_STATUSES = ("queued", "processing")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT UNIQUE NOT NULL,
+    api_key TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+
+# Deployment facts every process sharing the queue must agree on (see worker.check_data_volume)
+META_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+)
+"""
+
+class QueueFull(Exception):
+    def __init__(self, depth: int):
+        super().__init__(f"Job queue is full ({depth} jobs waiting)")
+        self.depth = depth
+
+def pick_next(rows, last_served: dict):
+    """Chooses among queued rows (ordered by priority, then seq) the one to run next.
+
+    Jobs are served highest priority first; within a priority, API keys take
+    turns (the key served least recently goes next) and each key is FIFO.
+    """
+    heads = {}
+    for row in rows:
+        heads.setdefault(row["api_key"], row)
+    return min(
+        heads.values(),
+        key=lambda r: (-r["priority"], last_served.get(r["api_key"], 0), r["seq"]),
+    )
+
+def connect_redis(url: str = REDIS_URL):
+    """An asyncio Redis client; nothing in the server may block the event loop on Redis."""
+    try:
+        import redis.asyncio
+    except ImportError:
+        raise RuntimeError("JOB_BACKEND=redis needs the redis package (pip install redis)")
+    return redis.asyncio.from_url(url, decode_responses=True)
+
+class JobQueue:
+    """Durable SQLite job queue, see pick_next for the order jobs are served in.
+
+    Several processes on one host can share the database; claims are atomic
+    and idle workers poll for jobs enqueued elsewhere. Methods are coroutines
+    to match RedisJobQueue; the SQLite calls themselves are local and short.
+    """
+
+    def __init__(self, db_path: Path = QUEUE_DB, max_size: int = MAX_QUEUE_SIZE):
+        self.max_size = max_size
+        self.db = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(SCHEMA)
+            # Every claim, depth check and prune filters on status
+            self.db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, updated_at)")
+            self.db.execute(META_SCHEMA)
+        self._last_served = {}
+        self._available = asyncio.Event()
+
+    async def depth(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    async def enqueue(self, job_id: str, api_key: str, payload: dict, state: dict, priority: int = 0) -> int:
+        """Adds a job and returns its queue position (1 = next). Raises QueueFull."""
+        depth = await self.depth()
+        if depth >= self.max_size:
+            raise QueueFull(depth)
+
+        now = time.time()
+        with self.db:
+            self.db.execute(
+                "INSERT INTO jobs (id, api_key, priority, status, payload, state, created_at, updated_at) "
+                "VALUES (?, ?, ?, 'queued', ?, ?, ?, ?)",
+                (job_id, api_key, priority, json.dumps(payload), json.dumps(state), now, now),
+            )
+        self._available.set()
+        return await self.position(job_id)
+
+    async def requeue(self, job_id: str, state: dict) -> int:
+        """Puts a finished job back in the queue (it keeps its original place). Raises QueueFull."""
+        depth = await self.depth()
+        if depth >= self.max_size:
+            raise QueueFull(depth)
+
+        await self.save_state(job_id, state)
+        self._available.set()
+        return await self.position(job_id)
+
+    async def position(self, job_id: str):
+        """Approximate 1-based position among queued jobs, or None if not queued."""
+        row = self.db.execute("SELECT seq, priority, status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if not row or row["status"] != "queued":
+            return None
+        ahead = self.db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND (priority > ? OR (priority = ? AND seq < ?))",
+            (row["priority"], row["priority"], row["seq"]),
+        ).fetchone()[0]
+        return ahead + 1
+
+    def _claim_next(self):
+        while True:
+            rows = self.db.execute(
+                "SELECT id, api_key, priority, seq, payload FROM jobs WHERE status = 'queued' ORDER BY priority DESC, seq ASC"
+            ).fetchall()
+            if not rows:
+                return None
+            chosen = pick_next(rows, self._last_served)
+
+            with self.db:
+                # Another process may have claimed it since the SELECT
+                claimed = self.db.execute(
+                    "UPDATE jobs SET status = 'processing', updated_at = ? WHERE id = ? AND status = 'queued'",
+                    (time.time(), chosen["id"]),
+                ).rowcount
+            if claimed:
+                self._last_served[chosen["api_key"]] = time.time()
+                return chosen["id"], json.loads(chosen["payload"])
+
+    async def dequeue(self):
+        """Waits for and claims the next job. Returns (job_id, payload)."""
+        while True:
+            claimed = self._claim_next()
+            if claimed:
+                return claimed
+            self._available.clear()
+            try:
+                await asyncio.wait_for(self._available.wait(), timeout=QUEUE_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    async def renew(self, job_id: str):
+        """Extends the lease of a job this process is running."""
+        with self.db:
+            self.db.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (time.time(), job_id))
+
+    async def save_state(self, job_id: str, state: dict):
+        """Persists the job's public state; its status column follows state['status']."""
+        with self.db:
+            self.db.execute(
+                "UPDATE jobs SET status = ?, state = ?, updated_at = ? WHERE id = ?",
+                (state["status"], json.dumps(state), time.time(), job_id),
+            )
+
+    async def attach(self, job_id: str, api_key: str, primary_id: str) -> dict:
+        """Records a job that shares the work of ``primary_id``; workers never claim it."""
+        state = {"status": "coalesced", "coalesced_with": primary_id}
+        now = time.time()
+        with self.db:
+            self.db.execute(
+                "INSERT INTO jobs (id, api_key, priority, status, payload, state, created_at, updated_at) "
+                "VALUES (?, ?, 0, 'coalesced', ?, ?, ?, ?)",
+                (job_id, api_key, json.dumps({"coalesced_with": primary_id}), json.dumps(state), now, now),
+            )
+        return state
+
+    async def active(self):
+        """(job_id, state) of every job that is queued or processing."""
+        rows = self.db.execute("SELECT id, state FROM jobs WHERE status IN ('queued', 'processing') ORDER BY seq").fetchall()
+        return [(row["id"], json.loads(row["state"])) for row in rows]
+
+    async def in_flight(self, coalesce_key: str):
+        """Id of the queued or running job doing the work for ``coalesce_key``, if any."""
+        return next((job_id for job_id, state in await self.active() if state.get("coalesce_key") == coalesce_key), None)
+
+    async def referenced_files(self, exclude: str = None, failed_within: float = None) -> set:
+        """Upload paths still needed by queued or running jobs, and by failed jobs that may be retried.
+
+        Failed jobs count only if they failed less than ``failed_within`` seconds ago (None: always).
+        """
+        since = time.time() - failed_within if failed_within is not None else 0
+        rows = self.db.execute(
+            "SELECT payload FROM jobs WHERE id != ? AND (status IN ('queued', 'processing') "
+            "OR (status = 'failed' AND updated_at >= ?))",
+            (exclude or "", since),
+        ).fetchall()
+        return {path for row in rows for path in json.loads(row["payload"]).get("file_paths", [])}
+
+    async def get_state(self, job_id: str):
+        row = self.db.execute("SELECT state FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row["state"]) if row else None
+
+    async def get_meta(self, key: str):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+
+    async def set_meta(self, key: str, value: str):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    async def recover(self, stale_after: float = None) -> int:
+        """Requeues processing jobs whose worker stopped.
+
+        With ``stale_after``, only jobs not renewed for that many seconds;
+        otherwise every processing job (the only worker process is restarting).
+        """
+        cutoff = time.time() - stale_after if stale_after is not None else float("inf")
+        rows = self.db.execute(
+            "SELECT id, state FROM jobs WHERE status = 'processing' AND updated_at < ?", (cutoff,)
+        ).fetchall()
+        for row in rows:
+            state = json.loads(row["state"])
+            state.update(status="queued", message="Resumed after a worker restart, waiting for a worker...")
+            await self.save_state(row["id"], state)
+        if rows:
+            logger.warning(f"Requeued {len(rows)} interrupted job(s)")
+            self._available.set()
+        return len(rows)
+
+    async def prune(self, retention_days: float = JOB_RETENTION_DAYS) -> int:
+        """Deletes finished jobs last updated more than ``retention_days`` ago."""
+        cutoff = time.time() - retention_days * 86400
+        with self.db:
+            removed = self.db.execute(
+                "DELETE FROM jobs WHERE status NOT IN ('queued', 'processing') AND updated_at < ?", (cutoff,)
+            ).rowcount
+        if removed:
+            logger.info(f"Pruned {removed} finished job(s) older than {retention_days:g} days")
+        return removed
+
+class RedisJobQueue:
+    """Job queue and job state in Redis, shared by API and worker processes across nodes.
+
+    Same interface and ordering as JobQueue. Each job is a hash; queued ids
+    sit in a sorted set by submission order and are claimed with an atomic
+    ZREM, so two workers can never take the same job.
+    """
+
+    def __init__(self, url: str = REDIS_URL, prefix: str = REDIS_PREFIX, max_size: int = MAX_QUEUE_SIZE):
+        self.max_size = max_size
+        self.prefix = prefix
+        self.db = connect_redis(url)
+        self.retention = int(JOB_RETENTION_DAYS * 86400)
+
+    def _key(self, *parts) -> str:
+        return self.prefix + ":".join(parts)
+
+    async def depth(self) -> int:
+        return await self.db.zcard(self._key("queued"))
+
+    async def _wake(self):
+        wakeup = self._key("wakeup")
+        async with self.db.pipeline() as pipe:
+            pipe.lpush(wakeup, 1)
+            pipe.ltrim(wakeup, 0, self.max_size)
+            await pipe.execute()
+
+    async def _insert(self, job_id: str, api_key: str, priority: int, status: str, payload: dict, state: dict):
+        now = time.time()
+        seq = await self.db.incr(self._key("seq"))
+        await self.db.hset(self._key("job", job_id), mapping={
+            "api_key": api_key, "priority": priority, "seq": seq, "status": status,
+            "payload": json.dumps(payload), "state": json.dumps(state), "created_at": now, "updated_at": now,
+        })
+        return seq
+
+    async def enqueue(self, job_id: str, api_key: str, payload: dict, state: dict, priority: int = 0) -> int:
+        """Adds a job and returns its queue position (1 = next). Raises QueueFull."""
+        depth = await self.depth()
+        if depth >= self.max_size:
+            raise QueueFull(depth)
+
+        seq = await self._insert(job_id, api_key, priority, "queued", payload, state)
+        await self.db.sadd(self._key("active"), job_id)
+        await self.db.zadd(self._key("queued"), {job_id: seq})
+        await self._wake()
+        return await self.position(job_id)
+
+    async def requeue(self, job_id: str, state: dict) -> int:
+        """Puts a finished job back in the queue (it keeps its original place). Raises QueueFull."""
+        depth = await self.depth()
+        if depth >= self.max_size:
+            raise QueueFull(depth)
+
+        await self.save_state(job_id, state)
+        await self._enqueue_existing(job_id)
+        await self._wake()
+        return await self.position(job_id)
+
+    async def _enqueue_existing(self, job_id: str):
+        seq = await self.db.hget(self._key("job", job_id), "seq")
+        await self.db.zadd(self._key("queued"), {job_id: int(seq)})
+
+    async def _queued_rows(self):
+        ids = await self.db.zrange(self._key("queued"), 0, -1)
+        async with self.db.pipeline() as pipe:
+            for job_id in ids:
+                pipe.hmget(self._key("job", job_id), "api_key", "priority", "seq")
+            fields = await pipe.execute()
+        rows = [
+            {"id": job_id, "api_key": api_key, "priority": int(priority), "seq": int(seq)}
+            for job_id, (api_key, priority, seq) in zip(ids, fields) if seq is not None
+        ]
+        return sorted(rows, key=lambda r: (-r["priority"], r["seq"]))
+
+    async def position(self, job_id: str):
+        """Approximate 1-based position among queued jobs, or None if not queued."""
+        rows = await self._queued_rows()
+        return next((i + 1 for i, row in enumerate(rows) if row["id"] == job_id), None)
+
+    async def _claim_next(self):
+        while True:
+            rows = await self._queued_rows()
+            if not rows:
+                return None
+            last_served = {key: float(at) for key, at in (await self.db.hgetall(self._key("served"))).items()}
+            chosen = pick_next(rows, last_served)
+            # Only one worker's ZREM can remove the id
+            if await self.db.zrem(self._key("queued"), chosen["id"]):
+                job = self._key("job", chosen["id"])
+                await self.db.hset(job, mapping={"status": "processing", "updated_at": time.time()})
+                await self.db.hset(self._key("served"), chosen["api_key"], time.time())
+                return chosen["id"], json.loads(await self.db.hget(job, "payload"))
+
+    async def dequeue(self):
+        """Waits for and claims the next job. Returns (job_id, payload)."""
+        while True:
+            claimed = await self._claim_next()
+            if claimed:
+                return claimed
+            await self.db.blpop([self._key("wakeup")], timeout=QUEUE_POLL_SECONDS)
+
+    async def renew(self, job_id: str):
+        """Extends the lease of a job this process is running."""
+        await self.db.hset(self._key("job", job_id), "updated_at", time.time())
+
+    async def save_state(self, job_id: str, state: dict):
+        """Persists the job's public state; its status follows state['status']."""
+        now = time.time()
+        job = self._key("job", job_id)
+        async with self.db.pipeline() as pipe:
+            pipe.hset(job, mapping={"status": state["status"], "state": json.dumps(state), "updated_at": now})
+            if state["status"] in ACTIVE_STATUSES:
+                pipe.sadd(self._key("active"), job_id)
+                pipe.persist(job)
+            else:
+                pipe.srem(self._key("active"), job_id)
+                pipe.expire(job, self.retention)
+            if state["status"] == "failed":
+                pipe.zadd(self._key("failed"), {job_id: now})
+            else:
+                pipe.zrem(self._key("failed"), job_id)
+            pipe.zremrangebyscore(self._key("failed"), 0, now - self.retention)
+            await pipe.execute()
+
+    async def attach(self, job_id: str, api_key: str, primary_id: str) -> dict:
+        """Records a job that shares the work of ``primary_id``; workers never claim it."""
+        state = {"status": "coalesced", "coalesced_with": primary_id}
+        await self._insert(job_id, api_key, 0, "coalesced", {"coalesced_with": primary_id}, state)
+        await self.db.expire(self._key("job", job_id), self.retention)
+        return state
+
+    async def _fields(self, ids, *fields):
+        async with self.db.pipeline() as pipe:
+            for job_id in ids:
+                pipe.hmget(self._key("job", job_id), *fields)
+            return list(zip(ids, await pipe.execute()))
+
+    async def active(self):
+        """(job_id, state) of every job that is queued or processing."""
+        rows = await self._fields(await self.db.smembers(self._key("active")), "state", "seq")
+        rows = sorted((row for row in rows if row[1][0] is not None), key=lambda row: int(row[1][1]))
+        return [(job_id, json.loads(state)) for job_id, (state, _) in rows]
+
+    async def in_flight(self, coalesce_key: str):
+        """Id of the queued or running job doing the work for ``coalesce_key``, if any."""
+        return next((job_id for job_id, state in await self.active() if state.get("coalesce_key") == coalesce_key), None)
+
+    async def referenced_files(self, exclude: str = None, failed_within: float = None) -> set:
+        """Upload paths still needed by queued or running jobs, and by failed jobs that may be retried.
+
+        Failed jobs count only if they failed less than ``failed_within`` seconds ago (None: always).
+        """
+        since = time.time() - failed_within if failed_within is not None else 0
+        ids = set(await self.db.smembers(self._key("active")))
+        ids.update(await self.db.zrangebyscore(self._key("failed"), since, "+inf"))
+        ids.discard(exclude)
+        return {
+            path for _, (payload,) in await self._fields(list(ids), "payload") if payload
+            for path in json.loads(payload).get("file_paths", [])
+        }
+
+    async def get_state(self, job_id: str):
+        state = await self.db.hget(self._key("job", job_id), "state")
+        return json.loads(state) if state else None
+
+    async def get_meta(self, key: str):
+        return await self.db.hget(self._key("meta"), key)
+
+    async def set_meta(self, key: str, value: str):
+        await self.db.hset(self._key("meta"), key, value)
+
+    async def recover(self, stale_after: float = None) -> int:
+        """Requeues processing jobs whose worker stopped (see JobQueue.recover)."""
+        cutoff = time.time() - stale_after if stale_after is not None else float("inf")
+        stale = [
+            job_id for job_id, (status, updated_at) in
+            await self._fields(await self.db.smembers(self._key("active")), "status", "updated_at")
+            if status == "processing" and float(updated_at) < cutoff
+        ]
+        for job_id in stale:
+            state = await self.get_state(job_id)
+            state.update(status="queued", message="Resumed after a worker restart, waiting for a worker...")
+            await self.save_state(job_id, state)
+            await self._enqueue_existing(job_id)
+        if stale:
+            logger.warning(f"Requeued {len(stale)} interrupted job(s)")
+            await self._wake()
+        return len(stale)
+
+    async def prune(self, retention_days: float = JOB_RETENTION_DAYS) -> int:
+        """Finished jobs expire on their own (see save_state); nothing to delete."""
+        return 0
+
+def create_job_queue():
+    """The queue selected by JOB_BACKEND ("local" or "redis")."""
+    if JOB_BACKEND == "redis":
+        return RedisJobQueue()
+    return JobQueue()
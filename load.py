@@ -5,6 +5,7 @@ from pathlib import Path
 from dotenv import load_dotenv  # <--- Added this to read .env file
 from gemini_webapi import GeminiClient
 from loguru import logger
+from shot_profiles import get_profile
 
 # 1. Load the .env file
 load_dotenv()
@@ -17,19 +18,10 @@ SECURE_1PSIDTS = os.getenv("GEMINI_1PSIDTS")
 INPUT_PRODUCT_IMAGE = "input/my_product.jpg"
 OUTPUT_DIR = Path("output_product_set")
 
-STYLE_PROMPT = """
-STYLE GUIDELINES:
-1. Lighting: Soft, diffused studio lighting mimicking natural daylight.
-2. Background: Pure white (#FFFFFF) seamless background.
-3. Product Focus: Perfectly sharp, centered, realistic geometry.
-4. Quality: Ultra-high resolution, commercial-grade clarity.
-"""
-
-SHOT_LIST = [
-    ("Front_View", "Generate a Front view of this product."),
-    ("Side_View", "Generate a Side view of this product."),
-    ("Lifestyle", "Generate a lifestyle image showing the product in realistic use on a table.")
-]
+# Quick three-shot set in the concise style, shared with the server (see shot_profiles.json)
+PROFILE = get_profile("quick")
+STYLE_PROMPT = PROFILE.style
+SHOT_LIST = PROFILE.shots
 
 async def get_client():
     # Check if cookies are loaded
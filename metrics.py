@@ -0,0 +1,135 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from loguru import logger
+
+# Optional per-job trace spans, one JSON object per line
+TRACE_FILE = os.getenv("TRACE_FILE")
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+# Job id of the work running in the current task, attached to trace spans
+current_job = contextvars.ContextVar("current_job", default=None)
+
+_lock = threading.Lock()
+_registry = []
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values = {}
+        _registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with _lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(dict(key))} {value}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with _lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, buckets=DURATION_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            series = self._values.setdefault(key, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with _lock:
+            items = [(key, dict(series, buckets=list(series["buckets"]))) for key, series in self._values.items()]
+        for key, series in items:
+            labels = dict(key)
+            for bound, count in zip(self.buckets, series["buckets"]):
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': bound})} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {series['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {series['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {series['count']}")
+        return lines
+
+def render_all() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def write_span(span: dict):
+    if not TRACE_FILE:
+        return
+    try:
+        with _lock, open(TRACE_FILE, "a") as f:
+            f.write(json.dumps(span) + "\n")
+    except OSError as e:
+        logger.warning(f"Could not write trace span: {e}")
+
+STAGE_SECONDS = Histogram("probaho_stage_duration_seconds", "Duration of generation stages")
+JOB_SECONDS = Histogram("probaho_job_duration_seconds", "End-to-end duration of jobs once picked up by a worker")
+JOBS_TOTAL = Counter("probaho_jobs_total", "Finished jobs by outcome")
+RETRIES_TOTAL = Counter("probaho_upstream_retries_total", "Retried upstream calls by call and reason")
+CACHE_LOOKUPS = Counter("probaho_cache_lookups_total", "Result cache lookups by result")
+COALESCED_JOBS = Counter("probaho_coalesced_jobs_total", "Submissions attached to an identical in-flight job")
+QUEUE_DEPTH = Gauge("probaho_queue_depth", "Jobs waiting in the queue")
+CLIENTS_READY = Gauge("probaho_clients_ready", "Initialised Gemini clients idle in the pool")
+ACCOUNT_ERROR_RATE = Gauge("probaho_account_error_rate", "Recent error rate per Gemini account")
+
+@contextmanager
+def stage(name: str, **labels):
+    """Times a block into probaho_stage_duration_seconds and the trace file.
+
+    Yields a dict; set ``["outcome"]`` on it to record something other than
+    "ok" (exceptions are recorded as "error").
+    """
+    labels.setdefault("shot", "")
+    result = {"outcome": "ok"}
+    started = time.time()
+    start = time.perf_counter()
+    try:
+        yield result
+    except BaseException:
+        result["outcome"] = "error"
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_SECONDS.observe(duration, stage=name, outcome=result["outcome"], **labels)
+        write_span({
+            "job_id": current_job.get(), "stage": name, **labels,
+            "outcome": result["outcome"], "start": started, "duration": round(duration, 4),
+        })
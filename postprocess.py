@@ -0,0 +1,96 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from loguru import logger
+from metrics import stage
+from PIL import Image, ImageOps
+
+POSTPROCESS_WORKERS = int(os.getenv("POSTPROCESS_WORKERS", "2"))
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "384"))
+MARKETPLACE_SIZE = int(os.getenv("MARKETPLACE_SIZE", "2000"))
+WEBP_QUALITY = int(os.getenv("WEBP_QUALITY", "82"))
+JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", "88"))
+VARIANTS_DIRNAME = "variants"
+
+_executor = None
+
+def variant_paths(path: Path) -> dict:
+    """Where the derivatives of a generated image live (next to it, in variants/)."""
+    out_dir = path.parent / VARIANTS_DIRNAME
+    return {
+        "webp": out_dir / f"{path.stem}.webp",
+        "jpeg": out_dir / f"{path.stem}.jpg",
+        "thumb": out_dir / f"{path.stem}_thumb.webp",
+        "marketplace": out_dir / f"{path.stem}_{MARKETPLACE_SIZE}.jpg",
+    }
+
+def _flatten(image: Image.Image) -> Image.Image:
+    """RGB on pure white. Building a new image also drops EXIF/XMP/ICC metadata."""
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ("RGBA", "LA") or "transparency" in image.info:
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    clean = Image.new("RGB", image.size)
+    clean.paste(image.convert("RGB"))
+    return clean
+
+def make_variants(path: str) -> dict:
+    """Writes WebP/JPEG copies, a thumbnail and a square marketplace image. Runs in a worker process."""
+    source = Path(path)
+    targets = variant_paths(source)
+    if all(t.exists() and t.stat().st_mtime >= source.stat().st_mtime for t in targets.values()):
+        return {name: str(t) for name, t in targets.items()}
+
+    targets["webp"].parent.mkdir(parents=True, exist_ok=True)
+    with Image.open(source) as original:
+        image = _flatten(original)
+
+    image.save(targets["webp"], "WEBP", quality=WEBP_QUALITY, method=4)
+    image.save(targets["jpeg"], "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+
+    thumb = image.copy()
+    thumb.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.LANCZOS)
+    thumb.save(targets["thumb"], "WEBP", quality=WEBP_QUALITY)
+
+    # Marketplace spec: product fitted inside a square canvas on pure white
+    fitted = ImageOps.contain(image, (MARKETPLACE_SIZE, MARKETPLACE_SIZE), Image.LANCZOS)
+    canvas = Image.new("RGB", (MARKETPLACE_SIZE, MARKETPLACE_SIZE), (255, 255, 255))
+    canvas.paste(fitted, ((MARKETPLACE_SIZE - fitted.width) // 2, (MARKETPLACE_SIZE - fitted.height) // 2))
+    canvas.save(targets["marketplace"], "JPEG", quality=JPEG_QUALITY, optimize=True)
+
+    return {name: str(t) for name, t in targets.items()}
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # Spawned, not forked: children must not inherit the server's sockets and signal handlers
+        _executor = ProcessPoolExecutor(max_workers=POSTPROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+async def process_image(path) -> dict:
+    """Builds the derivatives of one saved image off the event loop. Returns {variant: path}."""
+    loop = asyncio.get_running_loop()
+    with stage("postprocess"):
+        return await loop.run_in_executor(get_executor(), make_variants, str(path))
+
+async def process_images(paths) -> dict:
+    """Derivatives for many images; failures are logged and left out. Returns {path: variants}."""
+    async def safe(path):
+        try:
+            return path, await process_image(path)
+        except Exception as e:
+            logger.error(f"Post-processing failed for {path}: {e}")
+            return path, None
+
+    results = await asyncio.gather(*(safe(p) for p in paths))
+    return {path: variants for path, variants in results if variants}
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -0,0 +1,86 @@
+import asyncio
+import os
+from pathlib import Path
+from loguru import logger
+from PIL import Image, ImageChops, ImageOps
+from result_cache import file_digest
+from storage import PREPARED_DIR
+
+REFERENCE_PREPROCESS = os.getenv("REFERENCE_PREPROCESS", "true").lower() in ("1", "true", "yes")
+REFERENCE_MAX_EDGE = int(os.getenv("REFERENCE_MAX_EDGE", "1600"))
+REFERENCE_QUALITY = int(os.getenv("REFERENCE_QUALITY", "88"))
+REFERENCE_AUTOCROP = os.getenv("REFERENCE_AUTOCROP", "false").lower() in ("1", "true", "yes")
+# How far a pixel may differ from the corner colour and still count as background
+AUTOCROP_THRESHOLD = 24
+AUTOCROP_PADDING = 0.05
+
+# Prepared paths whose original turned out to be the smaller upload
+_passthrough = set()
+
+def _crop_to_product(image: Image.Image) -> Image.Image:
+    """Crops to the bounding box of whatever differs from the corner (background) colour."""
+    background = Image.new("RGB", image.size, image.getpixel((0, 0)))
+    mask = ImageChops.difference(image, background).convert("L").point(lambda v: 255 if v > AUTOCROP_THRESHOLD else 0)
+    bbox = mask.getbbox()
+    if not bbox:
+        return image
+    pad_x = int((bbox[2] - bbox[0]) * AUTOCROP_PADDING)
+    pad_y = int((bbox[3] - bbox[1]) * AUTOCROP_PADDING)
+    return image.crop((
+        max(0, bbox[0] - pad_x), max(0, bbox[1] - pad_y),
+        min(image.width, bbox[2] + pad_x), min(image.height, bbox[3] + pad_y),
+    ))
+
+def _prepare(source: Path, target: Path, max_edge: int, quality: int, autocrop: bool) -> bool:
+    """Writes the prepared JPEG. Returns False when the original is already the smaller upload."""
+    with Image.open(source) as original:
+        original_size = original.size
+        image = ImageOps.exif_transpose(original)
+        if image.mode in ("RGBA", "LA") or "transparency" in image.info:
+            image = image.convert("RGBA")
+            flattened = Image.new("RGB", image.size, (255, 255, 255))
+            flattened.paste(image, mask=image.getchannel("A"))
+            image = flattened
+        else:
+            image = image.convert("RGB")
+
+    if autocrop:
+        image = _crop_to_product(image)
+    image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    part = target.with_suffix(".part")
+    image.save(part, "JPEG", quality=quality, optimize=True)
+    untouched = not autocrop and image.size == original_size
+    if untouched and part.stat().st_size >= source.stat().st_size:
+        part.unlink()
+        return False
+    os.replace(part, target)
+    return True
+
+async def prepare_reference(path: Path, digest: str = None, max_edge: int = REFERENCE_MAX_EDGE,
+                            quality: int = REFERENCE_QUALITY, autocrop: bool = REFERENCE_AUTOCROP) -> Path:
+    """Returns a smaller, upright copy of a reference image to upload, cached by content hash.
+
+    The original file is never modified. If preparing it would not shrink the
+    upload, or Pillow cannot read it, the original path is returned.
+    """
+    digest = digest or await asyncio.to_thread(file_digest, path)
+    crop_tag = "_crop" if autocrop else ""
+    target = PREPARED_DIR / f"{digest[:32]}_{max_edge}_q{quality}{crop_tag}.jpg"
+    if target.exists():
+        return target
+    if target in _passthrough:
+        return path
+
+    PREPARED_DIR.mkdir(parents=True, exist_ok=True)
+    try:
+        prepared = await asyncio.to_thread(_prepare, path, target, max_edge, quality, autocrop)
+    except Exception as e:
+        logger.warning(f"Could not preprocess {path.name}, uploading it as-is: {e}")
+        return path
+
+    if not prepared:
+        _passthrough.add(target)
+        return path
+    logger.info(f"Prepared reference {path.name}: {path.stat().st_size // 1024} KB -> {target.stat().st_size // 1024} KB")
+    return target
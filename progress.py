@@ -0,0 +1,124 @@
+import asyncio
+import json
+from collections import defaultdict
+from loguru import logger
+from job_queue import JOB_BACKEND, REDIS_PREFIX, REDIS_URL, connect_redis
+
+TERMINAL_EVENTS = {"completed", "failed"}
+# Published once a finished job's remaining variants are built (see worker.finish_variants)
+VARIANTS_DONE = "variants_done"
+HEARTBEAT_SECONDS = 15
+
+class ProgressBroker:
+    """In-process fan-out of job events to server-sent-event subscribers."""
+
+    def __init__(self):
+        self._subscribers = defaultdict(set)
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def subscribe(self, job_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self._subscribers[job_id].add(queue)
+        return queue
+
+    def unsubscribe(self, job_id: str, queue: asyncio.Queue):
+        self._subscribers[job_id].discard(queue)
+        if not self._subscribers[job_id]:
+            del self._subscribers[job_id]
+
+    async def publish(self, job_id: str, event: dict):
+        self._deliver(job_id, event)
+
+    def _deliver(self, job_id: str, event: dict):
+        for queue in self._subscribers.get(job_id, ()):
+            queue.put_nowait(event)
+
+    async def stream(self, job_id: str, get_snapshot):
+        """Yields SSE frames: the current state first, then events until the job ends.
+
+        A job that ended with variants still being built streams on until they are done.
+        The snapshot is taken after subscribing so no event can fall in between.
+        """
+        queue = self.subscribe(job_id)
+        try:
+            snapshot = await get_snapshot()
+            yield format_event({"type": "snapshot", **snapshot})
+            if is_final(snapshot):
+                return
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    # The job may have ended in a process whose events do not reach this one
+                    snapshot = await get_snapshot()
+                    if is_final(snapshot):
+                        yield format_event({"type": snapshot["status"], **snapshot})
+                        return
+                    # Comment frame keeps proxies from closing an idle connection
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_event(event)
+                if event["type"] == VARIANTS_DONE or (event["type"] in TERMINAL_EVENTS and not event.get("variants_pending")):
+                    return
+        finally:
+            self.unsubscribe(job_id, queue)
+
+def is_final(job: dict) -> bool:
+    """Whether a job snapshot has nothing more to stream."""
+    return job.get("status") in TERMINAL_EVENTS and not job.get("variants_pending")
+
+def format_event(event: dict) -> str:
+    return f"data: {json.dumps(event)}\n\n"
+
+class RedisProgressBroker(ProgressBroker):
+    """Job events over Redis pub/sub, so subscribers get events published by any process.
+
+    One pattern subscription per process feeds the local subscriber queues.
+    """
+
+    def __init__(self, url: str = REDIS_URL, prefix: str = REDIS_PREFIX):
+        super().__init__()
+        self.channel_prefix = f"{prefix}events:"
+        self.db = connect_redis(url)
+        self._pubsub = None
+        self._task = None
+
+    async def start(self):
+        """Subscribes before returning, so no event published afterwards is missed."""
+        self._pubsub = self.db.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.psubscribe(self.channel_prefix + "*")
+        self._task = asyncio.create_task(self._listen())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+        if self._pubsub:
+            await self._pubsub.aclose()
+
+    async def publish(self, job_id: str, event: dict):
+        await self.db.publish(self.channel_prefix + job_id, json.dumps(event))
+
+    async def _listen(self):
+        while True:
+            try:
+                message = await self._pubsub.get_message(timeout=HEARTBEAT_SECONDS)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Progress event subscription failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            if message and message["type"] == "pmessage":
+                job_id = message["channel"][len(self.channel_prefix):]
+                self._deliver(job_id, json.loads(message["data"]))
+
+def create_progress_broker():
+    """The broker matching JOB_BACKEND ("local" or "redis")."""
+    if JOB_BACKEND == "redis":
+        return RedisProgressBroker()
+    return ProgressBroker()
@@ -0,0 +1,109 @@
+import asyncio
+import os
+import random
+import time
+from loguru import logger
+from metrics import RETRIES_TOTAL
+
+# --- Configuration (Defaults) ---
+# Rates are upstream calls per second, shared by every job in the process.
+SEND_RATE = float(os.getenv("GEMINI_SEND_RATE", "0.5"))
+SEND_RATE_MIN = float(os.getenv("GEMINI_SEND_RATE_MIN", "0.05"))
+SEND_RATE_MAX = float(os.getenv("GEMINI_SEND_RATE_MAX", "2"))
+SAVE_RATE = float(os.getenv("GEMINI_SAVE_RATE", "2"))
+SAVE_RATE_MIN = float(os.getenv("GEMINI_SAVE_RATE_MIN", "0.2"))
+SAVE_RATE_MAX = float(os.getenv("GEMINI_SAVE_RATE_MAX", "8"))
+RATE_BURST = float(os.getenv("GEMINI_RATE_BURST", "2"))
+RETRY_ATTEMPTS = int(os.getenv("GEMINI_RETRY_ATTEMPTS", "4"))
+RETRY_BASE_DELAY = float(os.getenv("GEMINI_RETRY_BASE_DELAY", "1"))
+RETRY_MAX_DELAY = float(os.getenv("GEMINI_RETRY_MAX_DELAY", "30"))
+
+class RateGovernor:
+    """Token bucket whose refill rate adapts AIMD-style.
+
+    Each success adds ``increase`` calls/s (up to ``max_rate``); each failure
+    multiplies the rate by ``decrease`` (down to ``min_rate``).
+    """
+
+    def __init__(self, name: str, rate: float, min_rate: float, max_rate: float, burst: float = RATE_BURST,
+                 increase: float = 0.05, decrease: float = 0.5):
+        self.name = name
+        # Metric label: the call type without any per-account suffix
+        self.kind = name.split("[")[0]
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Waits until a call is allowed. Waiters are served in arrival order."""
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+    def success(self):
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def failure(self):
+        previous = self.rate
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        # Drain the bucket so the lower rate takes effect immediately
+        self._tokens = min(self._tokens, 0)
+        logger.debug(f"{self.name} rate {previous:.2f}/s -> {self.rate:.2f}/s")
+
+def backoff_delay(attempt: int, base: float = RETRY_BASE_DELAY, cap: float = RETRY_MAX_DELAY) -> float:
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+async def call_with_retry(governor: RateGovernor, func, description: str, attempts: int = RETRY_ATTEMPTS,
+                          is_empty=None, retry_if=None):
+    """Runs ``func()`` through ``governor``, retrying with jittered exponential backoff.
+
+    Exceptions for which ``retry_if(exc)`` is false are raised immediately. A
+    result for which ``is_empty(result)`` is true counts as a failure too, and
+    is returned as-is once attempts run out.
+    """
+    for attempt in range(attempts):
+        await governor.acquire()
+        last_attempt = attempt == attempts - 1
+        try:
+            result = await func()
+        except Exception as e:
+            governor.failure()
+            if last_attempt or (retry_if and not retry_if(e)):
+                raise
+            delay = backoff_delay(attempt)
+            RETRIES_TOTAL.inc(call=governor.kind, reason="error")
+            logger.warning(f"{description} failed (attempt {attempt + 1}/{attempts}): {e}. Retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+
+        if is_empty and is_empty(result):
+            governor.failure()
+            if last_attempt:
+                return result
+            delay = backoff_delay(attempt)
+            RETRIES_TOTAL.inc(call=governor.kind, reason="empty")
+            logger.warning(f"{description} returned nothing (attempt {attempt + 1}/{attempts}). Retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+
+        governor.success()
+        return result
+
+# Process-wide governors shared by every generator and job
+send_governor = RateGovernor("send_message", SEND_RATE, SEND_RATE_MIN, SEND_RATE_MAX)
+save_governor = RateGovernor("image.save", SAVE_RATE, SAVE_RATE_MIN, SAVE_RATE_MAX)
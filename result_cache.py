@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from loguru import logger
+
+CACHE_DB = Path(os.getenv("CACHE_DB", "result_cache.db"))
+CACHE_MAX_AGE_DAYS = float(os.getenv("CACHE_MAX_AGE_DAYS", "30"))
+CACHE_MAX_MB = float(os.getenv("CACHE_MAX_MB", "500"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shots (
+    key TEXT PRIMARY KEY,
+    files TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+)
+"""
+
+def file_digest(path: Path) -> str:
+    """sha256 of a file's bytes, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def shot_key(image_digest: str, *prompts: str) -> str:
+    """Cache key for one shot: the reference image plus the exact prompt text sent upstream."""
+    digest = hashlib.sha256(image_digest.encode())
+    for prompt in prompts:
+        digest.update(b"\0" + prompt.encode())
+    return digest.hexdigest()
+
+class ResultCache:
+    """Per-shot index of generated files in OUTPUT_DIR, keyed by content hash.
+
+    Entries expire after ``max_age_days``; beyond ``max_mb`` the least recently
+    used entries are evicted. Evicting an entry only forgets it: the files may
+    still back a finished job's URLs, and deleting them is left to the storage
+    GC, which keeps its manifest and remote copies in step. An entry whose
+    files are gone is a miss.
+    """
+
+    def __init__(self, db_path: Path = CACHE_DB, max_age_days: float = CACHE_MAX_AGE_DAYS, max_mb: float = CACHE_MAX_MB):
+        self.max_age = max_age_days * 86400
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        # put() runs in a worker thread while get() runs on the event loop
+        self._lock = threading.RLock()
+        self.db = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.db:
+            self.db.execute(SCHEMA)
+            self.db.execute("CREATE INDEX IF NOT EXISTS shots_created ON shots (created_at)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS shots_last_used ON shots (last_used)")
+            # Output names are unique per prompt and job now, so the old file index is not needed
+            self.db.execute("DROP TABLE IF EXISTS shot_files")
+
+    def get(self, key: str):
+        """Returns the cached file paths for a shot, or None on a miss."""
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key: str):
+        row = self.db.execute("SELECT files FROM shots WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None
+
+        files = json.loads(row["files"])
+        if not all(Path(f).exists() for f in files):
+            # Files were removed behind our back; treat as a miss
+            self._delete(key)
+            return None
+
+        with self.db:
+            self.db.execute("UPDATE shots SET last_used = ? WHERE key = ?", (time.time(), key))
+        return files
+
+    def put(self, key: str, files):
+        """Records a shot's files; blocking, so async callers run it in a thread."""
+        files = [str(f) for f in files]
+        size = sum(Path(f).stat().st_size for f in files)
+        with self._lock:
+            self._put(key, files, size)
+
+    def _put(self, key: str, files, size: int):
+        now = time.time()
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO shots (key, files, size, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(files), size, now, now),
+            )
+        self._evict()
+
+    def _delete(self, key: str):
+        with self.db:
+            self.db.execute("DELETE FROM shots WHERE key = ?", (key,))
+
+    def evict(self) -> int:
+        """Drops expired entries, then least recently used ones until under the size cap."""
+        with self._lock:
+            return self._evict()
+
+    def _evict(self) -> int:
+        removed = 0
+        cutoff = time.time() - self.max_age
+        for row in self.db.execute("SELECT key FROM shots WHERE created_at < ?", (cutoff,)).fetchall():
+            self._delete(row["key"])
+            removed += 1
+
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM shots").fetchone()[0]
+        if total > self.max_bytes:
+            for row in self.db.execute("SELECT key, size FROM shots ORDER BY last_used ASC").fetchall():
+                if total <= self.max_bytes:
+                    break
+                self._delete(row["key"])
+                total -= row["size"]
+                removed += 1
+
+        if removed:
+            logger.info(f"Result cache evicted {removed} shot(s)")
+        return removed
@@ -1,46 +1,45 @@
 import os
 from dotenv import load_dotenv
-import shutil
+
+# Load .env before the modules below read their configuration
+load_dotenv()
+
 import asyncio
+import time
+import uuid
+import zipfile
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import List
-from fastapi import FastAPI, UploadFile, File, BackgroundTasks, HTTPException
+from typing import Dict, List
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from img_service import GeminiImageGenerator
+from accounts import DEFAULT_ACCOUNT, save_cookies
+from ingest import RequestSizeLimit, UploadTooLarge, store_uploads
+from job_queue import QueueFull
+import metrics
+from result_cache import file_digest, shot_key
+from shot_profiles import DEFAULT_PROFILE, ShotProfile, get_profile, load_profiles, shot_config_digest
+import storage as storage_backends
+from storage import OUTPUT_DIR, PREPARED_DIR, UPLOAD_DIR, UPLOAD_RETENTION_HOURS, sweep_dir
+# Light at import time: the Gemini/Pillow generator stack is only loaded by the workers
+import worker
+from worker import ACCOUNTS_CHANNEL, new_shot_states
 from loguru import logger
-import json
-from fastapi.security import APIKeyHeader
+from fastapi.security import APIKeyHeader, APIKeyQuery
 from fastapi import Security, Depends, status
 
-# Load .env file
-load_dotenv()
-
-CONFIG_FILE = Path("config.json")
 MASTER_API_KEY = os.getenv("MASTER_API_KEY", "probaho_master_secret")
-
-def load_cookies():
-    """Load cookies from config.json or fallback to .env"""
-    if CONFIG_FILE.exists():
-        try:
-            with open(CONFIG_FILE, "r") as f:
-                return json.load(f)
-        except Exception as e:
-            logger.error(f"Error loading config.json: {e}")
-    
-    return {
-        "GEMINI_1PSID": os.getenv("GEMINI_1PSID"),
-        "GEMINI_1PSIDTS": os.getenv("GEMINI_1PSIDTS")
-    }
-
-def save_cookies(psid: str, psidts: str):
-    """Save updated cookies to config.json"""
-    with open(CONFIG_FILE, "w") as f:
-        json.dump({"GEMINI_1PSID": psid, "GEMINI_1PSIDTS": psidts}, f)
+# Run the generation workers inside the API process; set to 0 when worker.py processes do the work
+RUN_WORKERS = os.getenv("RUN_WORKERS", "1").lower() not in ("0", "false", "no")
+# Frontend files; only this directory is served at /
+STATIC_DIR = Path(os.getenv("STATIC_DIR", Path(__file__).resolve().parent / "static"))
 
 API_KEY_NAME = "X-API-Key"
 api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
+api_key_query = APIKeyQuery(name="api_key", auto_error=False)
 
 async def get_api_key(api_key_header: str = Security(api_key_header)):
     if api_key_header == MASTER_API_KEY:
@@ -50,7 +49,50 @@ async def get_api_key(api_key_header: str = Security(api_key_header)):
         detail="Invalid or missing API Key",
     )
 
-app = FastAPI()
+async def get_stream_api_key(
+    api_key_header: str = Security(api_key_header),
+    api_key_query: str = Security(api_key_query),
+):
+    """EventSource cannot send headers, so event streams also accept ?api_key=."""
+    return await get_api_key(api_key_header or api_key_query)
+
+async def collect_garbage():
+    """Applies the storage quotas, clears out uploads no job needs any more and prunes old jobs."""
+    await worker.job_queue.prune()
+    retention = UPLOAD_RETENTION_HOURS * 3600
+    # File deletion runs in threads so the event loop stays responsive
+    needed = await worker.job_queue.referenced_files(failed_within=retention)
+    await asyncio.to_thread(worker.storage.collect_garbage)
+    await asyncio.to_thread(sweep_dir, UPLOAD_DIR, UPLOAD_RETENTION_HOURS, lambda p: str(p) in needed)
+    await asyncio.to_thread(sweep_dir, PREPARED_DIR, UPLOAD_RETENTION_HOURS)
+
+async def gc_loop():
+    while True:
+        try:
+            await collect_garbage()
+        except Exception as e:
+            logger.error(f"Storage GC failed: {e}")
+        await asyncio.sleep(storage_backends.GC_INTERVAL_MINUTES * 60)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    worker.open_backends()
+    # Separate worker processes check they see the same uploads and outputs
+    await worker.claim_data_volume()
+    await worker.progress_broker.start()
+    workers = []
+    if RUN_WORKERS:
+        # Jobs interrupted by a previous run are requeued by reap_loop once their lease expires
+        workers = worker.start_workers()
+    gc_task = asyncio.create_task(gc_loop())
+    yield
+    gc_task.cancel()
+    await worker.stop_workers(workers)
+    await worker.progress_broker.close()
+
+app = FastAPI(lifespan=lifespan)
 
 # Enable CORS for frontend development
 app.add_middleware(
@@ -60,17 +102,37 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Oversized uploads are refused before Starlette spools them to disk
+app.add_middleware(RequestSizeLimit)
 
-UPLOAD_DIR = Path("uploads")
-OUTPUT_DIR = Path("output_product_set")
-UPLOAD_DIR.mkdir(exist_ok=True)
-OUTPUT_DIR.mkdir(exist_ok=True)
+LAST_SYNC_TIME = "Never"
 
-# We will create fresh generators per job for better session isolation
+def coalesce_key(file_paths: List[Path], bypass_cache: bool, profile: ShotProfile) -> str:
+    """Single-flight key: the uploads' content (they are stored by hash) plus the shot prompts."""
+    return shot_key(shot_config_digest(profile), *(p.stem for p in file_paths), f"bypass_cache={bypass_cache}")
 
-# Simple shared state for progress (In a real app, use Redis or similar)
-jobs = {}
-LAST_SYNC_TIME = "Never"
+async def resolve_job(job_id: str):
+    """(job_id, state) of the job doing the work; a coalesced job resolves to its primary.
+
+    State is read from the job queue, so any API process can answer for a job run anywhere.
+    """
+    job = await worker.job_queue.get_state(job_id)
+    if job and job.get("coalesced_with"):
+        job_id = job["coalesced_with"]
+        job = await worker.job_queue.get_state(job_id)
+    return job_id, job
+
+def queue_full(error: QueueFull) -> HTTPException:
+    """429 telling the client to come back once the queue has drained a little."""
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail={"message": "Job queue is full, try again later", "queue_depth": error.depth},
+        headers={"Retry-After": "30"},
+    )
+
+def output_key(url: str) -> str:
+    """Storage key behind an /outputs URL."""
+    return url.split("?", 1)[0].removeprefix("/outputs/")
 
 class JobStatus(BaseModel):
     job_id: str
@@ -78,88 +140,181 @@ class JobStatus(BaseModel):
     progress: float
     message: str
     results: List[str] = []
-
-async def run_generation_task(job_id: str, file_paths: List[Path]):
-    jobs[job_id]["status"] = "processing"
-    all_results = []
-    
-    try:
-        # Load latest cookies (from config or env)
-        cookies = load_cookies()
-        
-        # Create a fresh generator for each job to ensure clean session (matches img.py pattern)
-        job_generator = GeminiImageGenerator(
-            psid=cookies.get("GEMINI_1PSID"),
-            psidts=cookies.get("GEMINI_1PSIDTS"),
-            proxy=os.getenv("GEMINI_PROXY")
-        )
-        await job_generator.init_client()
-
-        total_files = len(file_paths)
-        for idx, file_path in enumerate(file_paths):
-            jobs[job_id]["message"] = f"Processing image {idx + 1}/{total_files}: {file_path.name}"
-            
-            async def progress_update(data):
-                jobs[job_id]["message"] = f"Image {idx + 1}/{total_files}: {data['message']}"
-                # Update progress roughly
-                base_progress = (idx / total_files) * 100
-                step_progress = 100 / total_files
-                # We can't easily track internal progress of SHOT_LIST here without more complex logic
-                # So we just keep it at base for now
-
-            results = await job_generator.generate_for_image(file_path, OUTPUT_DIR, progress_callback=progress_update)
-            all_results.extend([f"/outputs/{os.path.basename(r)}" for r in results])
-            
-            jobs[job_id]["progress"] = ((idx + 1) / total_files) * 100
-            jobs[job_id]["results"] = all_results
-
-        jobs[job_id]["status"] = "completed"
-        jobs[job_id]["message"] = "All images generated successfully!"
-        
-    except Exception as e:
-        logger.error(f"Job {job_id} failed: {e}")
-        jobs[job_id]["status"] = "failed"
-        jobs[job_id]["message"] = f"Error: {str(e)}"
+    variants: Dict[str, Dict[str, str]] = {}
 
 @app.post("/upload")
 async def upload_images(
-    background_tasks: BackgroundTasks, 
     files: List[UploadFile] = File(...),
+    priority: int = Form(0),
+    bypass_cache: bool = Form(False),
+    profile: str = Form(DEFAULT_PROFILE),
     api_key: str = Depends(get_api_key)
 ):
-    job_id = f"job_{int(asyncio.get_event_loop().time())}"
-    file_paths = []
-    
-    for file in files:
-        file_path = UPLOAD_DIR / file.filename
-        with file_path.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        file_paths.append(file_path)
-    
-    jobs[job_id] = {
+    try:
+        shot_profile = get_profile(profile)
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=str(e.args[0]))
+
+    # Refuse early instead of writing files we cannot schedule
+    depth = await worker.job_queue.depth()
+    if depth >= worker.job_queue.max_size:
+        raise queue_full(QueueFull(depth))
+
+    job_id = f"job_{uuid.uuid4().hex[:12]}"
+    try:
+        # Stored under their content hash, so same-named files from other jobs never collide
+        file_paths = await store_uploads(files, UPLOAD_DIR)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+    key = coalesce_key(file_paths, bypass_cache, shot_profile)
+    primary_id = await worker.job_queue.in_flight(key)
+    if primary_id:
+        # Same images and shots are already on their way: share that job's work and results
+        await worker.job_queue.attach(job_id, api_key, primary_id)
+        metrics.COALESCED_JOBS.inc()
+        logger.info(f"{job_id} coalesced with in-flight {primary_id}")
+        return {"job_id": job_id, "queue_position": await worker.job_queue.position(primary_id), "coalesced_with": primary_id}
+
+    state = {
         "status": "queued",
         "progress": 0,
-        "message": "Files uploaded, starting generation...",
-        "results": []
+        "message": "Files uploaded, waiting for a worker...",
+        "results": [],
+        "variants": {},
+        "profile": shot_profile.name,
+        "images": new_shot_states([file.filename for file in files], shot_profile.shot_names),
+        "queued_at": time.time(),
+        "coalesce_key": key
+    }
+
+    try:
+        position = await worker.job_queue.enqueue(
+            job_id, api_key,
+            {
+                "file_paths": [str(p) for p in file_paths],
+                "file_names": [file.filename for file in files],
+                "bypass_cache": bypass_cache,
+                "profile": shot_profile.name,
+            },
+            state, priority=priority
+        )
+    except QueueFull as e:
+        raise queue_full(e)
+    return {"job_id": job_id, "queue_position": position}
+
+@app.get("/profiles")
+async def list_profiles(api_key: str = Depends(get_api_key)):
+    """Shot profiles that /upload accepts."""
+    return {
+        "default": DEFAULT_PROFILE,
+        "profiles": {
+            name: {"shots": p.shot_names, "max_variants": p.max_variants}
+            for name, p in load_profiles().items()
+        },
     }
-    
-    background_tasks.add_task(run_generation_task, job_id, file_paths)
-    
-    return {"job_id": job_id}
 
 @app.get("/status/{job_id}")
 async def get_status(job_id: str, api_key: str = Depends(get_api_key)):
-    if job_id not in jobs:
+    work_id, job = await resolve_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if work_id != job_id:
+        job = {**job, "coalesced_with": work_id}
+    if job["status"] == "queued":
+        return {**job, "queue_position": await worker.job_queue.position(work_id)}
+    return job
+
+@app.post("/jobs/{job_id}/retry")
+async def retry_job(job_id: str, api_key: str = Depends(get_api_key)):
+    """Requeues a failed job; only its shots that did not finish are generated again."""
+    job_id, job = await resolve_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] != "failed":
+        raise HTTPException(status_code=409, detail=f"Only failed jobs can be retried (job is {job['status']})")
+    if job.get("variants_pending"):
+        # The worker that ran it is still recording its variants
+        raise HTTPException(
+            status_code=409, detail="The job's previews are still being prepared, retry in a few seconds",
+            headers={"Retry-After": "5"},
+        )
+
+    retried = 0
+    for image in job.get("images") or []:
+        for shot in image["shots"].values():
+            if shot["status"] != "done":
+                shot.update(status="pending", error=None)
+                retried += 1
+    job.update(status="queued", message=f"Retrying {retried} shot(s), waiting for a worker...", queued_at=time.time())
+
+    try:
+        position = await worker.job_queue.requeue(job_id, job)
+    except QueueFull as e:
+        raise queue_full(e)
+    await worker.progress_broker.publish(job_id, {"type": "status", "status": "queued", "message": job["message"]})
+
+    return {"job_id": job_id, "queue_position": position, "shots": retried}
+
+@app.get("/events/{job_id}")
+async def stream_events(job_id: str, api_key: str = Depends(get_stream_api_key)):
+    """Server-sent events for a job: a snapshot, then incremental progress until it ends.
+
+    /status stays available as a polling fallback. A coalesced job streams its primary's events.
+    """
+    work_id, job = await resolve_job(job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    return jobs[job_id]
+
+    async def snapshot():
+        _, job = await resolve_job(job_id)
+        if work_id != job_id:
+            job = {**job, "coalesced_with": work_id}
+        if job["status"] == "queued":
+            return {**job, "queue_position": await worker.job_queue.position(work_id)}
+        return job
+
+    return StreamingResponse(
+        worker.progress_broker.stream(work_id, snapshot),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus scrape endpoint."""
+    await worker.update_metrics()
+    return PlainTextResponse(metrics.render_all(), media_type="text/plain; version=0.0.4")
 
 @app.get("/ping")
 async def ping():
     return {"status": "alive", "message": "pong"}
 
+@app.get("/ready")
+async def ready():
+    """Readiness, unlike /ping (liveness): 503 until this process can start jobs without waiting.
+
+    With in-process workers that means the client pool has warmed up and holds
+    at least one ready client; an API-only process is ready once its queue answers.
+    """
+    try:
+        depth = await worker.job_queue.depth()
+    except Exception as e:
+        return JSONResponse({"status": "unavailable", "error": f"Job queue: {e}"}, status_code=503)
+    body = {"status": "ready", "workers": RUN_WORKERS, "queue_depth": depth}
+    if RUN_WORKERS:
+        pool = worker.client_pool
+        body["clients_ready"] = pool.ready_count() if pool else 0
+        if not worker.pool_warm:
+            body["status"] = "warming"
+        elif not body["clients_ready"]:
+            body["status"] = "no_clients"
+    return JSONResponse(body, status_code=200 if body["status"] == "ready" else 503)
+
 class CookieUpdate(BaseModel):
     psid: str
     psidts: str
+    account: str = DEFAULT_ACCOUNT
 
 @app.post("/admin/sync-cookies")
 async def sync_cookies(data: CookieUpdate, api_key: str = Depends(get_api_key)):
@@ -167,18 +322,128 @@ async def sync_cookies(data: CookieUpdate, api_key: str = Depends(get_api_key)):
     try:
         from datetime import datetime
         sync_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        save_cookies(data.psid, data.psidts)
-        logger.success(f"Cookies updated via sync API at {sync_time}")
+        save_cookies(data.psid, data.psidts, data.account)
+        logger.success(f"Cookies for account '{data.account}' updated via sync API at {sync_time}")
+        # Every worker process retires the account's clients built with the old cookies
+        await worker.progress_broker.publish(ACCOUNTS_CHANNEL, {"type": "cookies_synced", "account": data.account})
         global LAST_SYNC_TIME
         LAST_SYNC_TIME = sync_time
-        return {"status": "success", "message": f"Cookies updated and persisted at {sync_time}"}
+        return {"status": "success", "message": f"Cookies for account '{data.account}' updated and persisted at {sync_time}"}
     except Exception as e:
         logger.error(f"Sync error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+ZIP_CHUNK_SIZE = 256 * 1024
+
+class ZipSink:
+    """Write-only stream for ZipFile; the response drains it after every chunk."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data) -> int:
+        self.buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+def job_archive_entries(job: dict, include_variants: bool = True) -> list:
+    """(name in the archive, storage key) for every file a job saved, one folder per input image."""
+    entries = []
+    folders = set()
+    variants = job.get("variants") or {}
+    for idx, image in enumerate(job.get("images") or []):
+        folder = Path(image["name"]).stem or f"image_{idx + 1}"
+        if folder in folders:
+            folder = f"{folder}_{idx + 1}"
+        folders.add(folder)
+        for shot_name, shot in image["shots"].items():
+            for n, url in enumerate(shot["files"], 1):
+                key = output_key(url)
+                # Stored names carry the upload hash and a prompt digest; the archive just numbers the shots
+                name = f"{shot_name}_v{n}"
+                entries.append((f"{folder}/{name}{Path(key).suffix}", key))
+                if include_variants:
+                    for variant_url in (variants.get(url) or {}).values():
+                        variant_key = output_key(variant_url)
+                        variant_name = Path(variant_key).name.replace(Path(key).stem, name, 1)
+                        entries.append((f"{folder}/variants/{variant_name}", variant_key))
+    return entries
+
+def stream_zip(entries):
+    """Yields a ZIP of ``entries`` as it is written; only one chunk is ever held in memory."""
+    sink = ZipSink()
+    # Images are already compressed, so entries are stored as-is
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED) as archive:
+        for name, key in entries:
+            source = worker.storage.open(key)
+            if source is None:
+                logger.warning(f"Skipping {key} in archive: no longer stored")
+                continue
+            with source, archive.open(name, "w") as member:
+                while chunk := source.read(ZIP_CHUNK_SIZE):
+                    member.write(chunk)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+@app.get("/jobs/{job_id}/download")
+async def download_job(job_id: str, variants: bool = True, api_key: str = Depends(get_stream_api_key)):
+    """Every file of a job as one ZIP, streamed as it is built (browser links pass ?api_key=)."""
+    _, job = await resolve_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    entries = job_archive_entries(job, variants)
+    if not entries:
+        raise HTTPException(status_code=404, detail="Job has no saved images yet")
+    return StreamingResponse(
+        stream_zip(entries),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{job_id}.zip"', "Cache-Control": "no-store"},
+    )
+
+def strong_etag(key: str, path: Path) -> str:
+    """Content hash of a local file: the manifest's when still current, otherwise computed."""
+    entry = worker.storage.lookup(key)
+    if entry and entry.get("digest") and entry["size"] == path.stat().st_size:
+        return entry["digest"]
+    return file_digest(path)
+
+@app.get("/outputs/{key:path}")
+async def serve_output(key: str, request: Request, v: str = None):
+    """Generated files: from local disk while present, otherwise redirected to the object store.
+
+    Local files carry a strong ETag (their content hash) and support Range requests;
+    versioned URLs (?v= matching the hash) are immutable and cached for a year.
+    """
+    try:
+        path = worker.storage.local_path(key)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Not found")
+    if path.is_file():
+        digest = await asyncio.to_thread(strong_etag, key, path)
+        headers = {
+            "ETag": f'"{digest}"',
+            "Cache-Control": "public, max-age=31536000, immutable" if v == digest[:16] else "no-cache",
+        }
+        if_none_match = request.headers.get("if-none-match", "")
+        if if_none_match.strip() == "*" or f'"{digest}"' in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+        # FileResponse answers Range and If-Range itself, using the ETag above
+        return FileResponse(path, headers=headers)
+    url = await asyncio.to_thread(worker.storage.remote_url, key)
+    if url:
+        return RedirectResponse(url)
+    raise HTTPException(status_code=404, detail="Not found")
+
 # Mount static files (MUST BE LAST to avoid shadowing routes)
-app.mount("/outputs", StaticFiles(directory=OUTPUT_DIR), name="outputs")
-app.mount("/", StaticFiles(directory=".", html=True), name="static")
+app.mount("/", StaticFiles(directory=STATIC_DIR, html=True), name="static")
 
 if __name__ == "__main__":
     import uvicorn
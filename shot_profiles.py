@@ -0,0 +1,115 @@
+import json
+import os
+from pathlib import Path
+from loguru import logger
+from result_cache import shot_key
+
+# Ships next to this module, so the default does not depend on the working directory
+PROFILES_FILE = Path(os.getenv("SHOT_PROFILES_FILE", Path(__file__).resolve().parent / "shot_profiles.json"))
+DEFAULT_PROFILE = os.getenv("SHOT_PROFILE", "full")
+DEFAULT_STYLE = "studio"
+
+STYLE_PROMPT = """
+STYLE GUIDELINES:
+1. Lighting: Soft, diffused studio lighting mimicking natural daylight. Balanced highlights, gentle shadows, no harsh reflections.
+2. Background: Pure white (#FFFFFF) seamless background. Minimal and clean.
+3. Product Focus: Perfectly sharp, centered, realistic geometry. No props.
+4. Color: Accurate white balance, no oversaturation.
+5. Quality: Ultra-high resolution, commercial-grade clarity, Amazon/Shopify ready.
+6. Retouching: Remove dust/imperfections but keep authentic texture.
+7. Shadow: Add a subtle, natural drop shadow for grounding.
+"""
+
+SHOT_LIST = [
+    ("Front_View", "Generate a Front view of this product."),
+    ("Back_View", "Generate a Back view of this product."),
+    ("Side_View", "Generate a Side view of this product."),
+    ("Three_Quarter", "Generate a 45-degree three-quarter angle view of this product."),
+    ("Detail_Shot", "Generate a Close-up detail shot highlighting texture and material."),
+    ("Lifestyle", "Generate a lifestyle image showing the product in realistic use on a table.")
+]
+
+REFERENCE_PROMPT = (
+    "You are a professional e-commerce product photographer/AI. "
+    "I am uploading ONE reference image of a product. Your job is to generate variations of THIS EXACT product from different angles. "
+    "CRITICAL: Maintain the exact geometry, branding, and materials of the product in the image. Do NOT invent a new product."
+)
+
+class ShotProfile:
+    """A named selection of shots, the style they are rendered in and how many variants to keep."""
+
+    def __init__(self, name: str, shots, style: str = STYLE_PROMPT, max_variants: int = None):
+        self.name = name
+        self.shots = list(shots)
+        self.style = style
+        self.max_variants = max_variants
+
+    @property
+    def shot_names(self):
+        return [shot_name for shot_name, _ in self.shots]
+
+    def __repr__(self):
+        return f"ShotProfile({self.name!r}, shots={self.shot_names}, max_variants={self.max_variants})"
+
+def default_profile() -> ShotProfile:
+    """Every built-in shot in the studio style, with every variant kept."""
+    return ShotProfile("full", SHOT_LIST)
+
+def build_shot_prompt(shot_name, shot_instruction, style=STYLE_PROMPT):
+    """Stricter prompt referring to the initial reference context."""
+    return (
+        f"Task: Generate the '{shot_name}' variant.\n"
+        f"Instruction: {shot_instruction}\n"
+        f"Reference: Use the product from the uploaded image ONLY.\n\n"
+        f"{style}\n"
+        f"IMPORTANT: The generated output MUST be an image of the exact same product as shown in our first message."
+    )
+
+def shot_config_digest(profile: ShotProfile = None) -> str:
+    """Fingerprint of the prompts a profile's shots are generated with and the variants it keeps."""
+    profile = profile or default_profile()
+    prompts = [build_shot_prompt(name, instruction, profile.style) for name, instruction in profile.shots]
+    return shot_key("shot-config", REFERENCE_PROMPT, *prompts, f"max_variants={profile.max_variants}")
+
+def read_profiles_file():
+    if PROFILES_FILE.exists():
+        try:
+            with open(PROFILES_FILE, "r") as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"Error loading {PROFILES_FILE}: {e}")
+    return {}
+
+def load_profiles() -> dict:
+    """Shot profiles by name, from the profiles file plus the built-in "full" profile.
+
+    The file holds {"styles": {name: text}, "shots": {name: instruction},
+    "profiles": {name: {"shots": [shot names], "style": style name, "max_variants": n}}};
+    its styles and shots extend the built-in "studio" style and SHOT_LIST.
+    """
+    config = read_profiles_file()
+    styles = {DEFAULT_STYLE: STYLE_PROMPT, **config.get("styles", {})}
+    shots = {**dict(SHOT_LIST), **config.get("shots", {})}
+
+    profiles = {"full": default_profile()}
+    for name, spec in config.get("profiles", {}).items():
+        unknown = [s for s in spec.get("shots", []) if s not in shots]
+        style = spec.get("style", DEFAULT_STYLE)
+        if unknown or style not in styles:
+            logger.error(f"Skipping shot profile '{name}': unknown shots {unknown} or style '{style}'")
+            continue
+        profiles[name] = ShotProfile(
+            name,
+            [(s, shots[s]) for s in spec.get("shots") or dict(SHOT_LIST)],
+            style=styles[style],
+            max_variants=spec.get("max_variants"),
+        )
+    return profiles
+
+def get_profile(name: str = None) -> ShotProfile:
+    """Raises KeyError for a profile that is not configured."""
+    name = name or DEFAULT_PROFILE
+    profiles = load_profiles()
+    if name not in profiles:
+        raise KeyError(f"Unknown shot profile '{name}'. Available: {', '.join(sorted(profiles))}")
+    return profiles[name]
@@ -6,9 +6,11 @@ const statusCard = document.getElementById('statusCard');
 const progressBar = document.getElementById('progressBar');
 const statusMessage = document.getElementById('statusMessage');
 const gallery = document.getElementById('gallery');
+const downloadAll = document.getElementById('downloadAll');
 
 let uploadedFiles = [];
 let pollingInterval = null;
+let eventSource = null;
 
 dropZone.onclick = () => fileInput.click();
 
@@ -55,6 +57,7 @@ generateBtn.onclick = async () => {
     statusMessage.textContent = 'Uploading files...';
     progressBar.style.width = '0%';
     gallery.innerHTML = '';
+    downloadAll.style.display = 'none';
 
     const formData = new FormData();
     uploadedFiles.forEach(file => formData.append('files', file));
@@ -79,7 +82,7 @@ generateBtn.onclick = async () => {
         const data = await response.json();
         const jobId = data.job_id;
 
-        startPolling(jobId, apiKey);
+        startEventStream(jobId, apiKey);
     } catch (error) {
         statusMessage.textContent = 'Upload failed: ' + error.message;
         generateBtn.disabled = false;
@@ -87,9 +90,83 @@ generateBtn.onclick = async () => {
     }
 };
 
+// Push updates over server-sent events; falls back to polling /status if the stream fails
+function startEventStream(jobId, apiKey) {
+    if (!window.EventSource) {
+        startPolling(jobId, apiKey);
+        return;
+    }
+    if (eventSource) eventSource.close();
+
+    let finished = false;
+    eventSource = new EventSource(`/events/${jobId}?api_key=${encodeURIComponent(apiKey)}`);
+
+    eventSource.onmessage = (e) => {
+        const event = JSON.parse(e.data);
+
+        if (event.message) statusMessage.textContent = event.message;
+        if (event.progress !== undefined) progressBar.style.width = event.progress + '%';
+
+        if (event.type === 'snapshot' && event.results && event.results.length > 0) {
+            updateGallery(event.results, event.variants);
+        } else if (event.type === 'image_saved') {
+            addGalleryItem(event.url);
+        } else if (event.type === 'variants_ready') {
+            applyVariants(event.url, event.variants);
+        }
+
+        // shot_state events carry a per-shot status too; only job-level events end the job
+        const jobEvent = ['completed', 'failed', 'snapshot'].includes(event.type);
+        if (jobEvent && (event.status === 'completed' || event.status === 'failed')) {
+            if (event.results) updateGallery(event.results, event.variants);
+            if (!finished) finishJob(event.status, jobId, apiKey);
+            finished = true;
+            // Previews still being built keep arriving as variants_ready events
+            if (!event.variants_pending) eventSource.close();
+        } else if (event.type === 'variants_done') {
+            eventSource.close();
+        }
+    };
+
+    eventSource.onerror = () => {
+        eventSource.close();
+        if (!finished) {
+            console.warn('Event stream lost, falling back to polling.');
+            startPolling(jobId, apiKey);
+        }
+    };
+}
+
+function finishJob(jobStatus, jobId, apiKey) {
+    generateBtn.disabled = false;
+
+    // Every saved image and its variants in one archive, streamed by the server
+    if (gallery.children.length > 0) {
+        downloadAll.href = `/jobs/${jobId}/download?api_key=${encodeURIComponent(apiKey)}`;
+        downloadAll.style.display = 'inline-flex';
+    }
+
+    if (jobStatus === 'failed') {
+        statusCard.classList.add('failed'); // We can add some CSS for this
+    }
+
+    // Notify the game that generation is complete
+    const iframe = document.getElementById('loaderIframe');
+    if (iframe && iframe.contentWindow) {
+        iframe.contentWindow.postMessage('generationComplete', '*');
+    }
+
+    // Automatically hide after 5 seconds so user can see their score
+    // and any final error message if it failed
+    setTimeout(() => {
+        hideLoader();
+    }, 5000);
+}
+
 function startPolling(jobId, apiKey) {
     if (pollingInterval) clearInterval(pollingInterval);
 
+    let finished = false;
     pollingInterval = setInterval(async () => {
         try {
             const response = await fetch(`/status/${jobId}`, {
@@ -110,28 +187,14 @@ function startPolling(jobId, apiKey) {
             progressBar.style.width = (data.progress || 0) + '%';
 
             if (data.results && data.results.length > 0) {
-                updateGallery(data.results);
+                updateGallery(data.results, data.variants);
             }
 
             if (data.status === 'completed' || data.status === 'failed') {
-                clearInterval(pollingInterval);
-                generateBtn.disabled = false;
-
-                if (data.status === 'failed') {
-                    statusCard.classList.add('failed'); // We can add some CSS for this
-                }
-
-                // Notify the game that generation is complete
-                const iframe = document.getElementById('loaderIframe');
-                if (iframe && iframe.contentWindow) {
-                    iframe.contentWindow.postMessage('generationComplete', '*');
-                }
-
-                // Automatically hide after 5 seconds so user can see their score
-                // and any final error message if it failed
-                setTimeout(() => {
-                    hideLoader();
-                }, 5000);
+                if (!finished) finishJob(data.status, jobId, apiKey);
+                finished = true;
+                // Keep polling for previews still being built
+                if (!data.variants_pending) clearInterval(pollingInterval);
             }
         } catch (error) {
             console.error('Polling error:', error);
@@ -156,34 +219,48 @@ const shotNameMap = {
     'Lifestyle': 'Lifestyle Scene'
 };
 
-function updateGallery(results) {
-    if (results.length > gallery.children.length) {
-        const newResults = results.slice(gallery.children.length);
-        newResults.forEach(url => {
-            const fileName = url.split('/').pop();
-            // Extract shot name from filename (e.g., photo_Front_View_v1.png)
-            let displayName = fileName;
-            for (const [key, value] of Object.entries(shotNameMap)) {
-                if (fileName.includes(key)) {
-                    displayName = value;
-                    break;
-                }
-            }
+function updateGallery(results, variants = {}) {
+    // Results may already be shown from streamed events
+    results.forEach(url => {
+        addGalleryItem(url);
+        if (variants && variants[url]) applyVariants(url, variants[url]);
+    });
+}
 
-            const item = document.createElement('div');
-            item.className = 'gallery-item';
-            item.innerHTML = `
-                <img src="${url}" alt="generated">
-                <div class="gallery-item-info">
-                    <span>${displayName}</span>
-                    <button class="download-btn" onclick="downloadImage('${url}', '${fileName}')">
-                        <i class="fa-solid fa-download"></i>
-                    </button>
-                </div>
-            `;
-            gallery.appendChild(item);
-        });
+// Previews use the small thumbnail; downloads keep the full-size original
+function applyVariants(url, variants) {
+    const item = gallery.querySelector(`[data-url="${url}"]`);
+    if (!item || !variants.thumb) return;
+    item.querySelector('img').src = variants.thumb;
+}
+
+function addGalleryItem(url) {
+    if (gallery.querySelector(`[data-url="${url}"]`)) return;
+
+    // Output URLs carry a ?v= content version
+    const fileName = url.split('?')[0].split('/').pop();
+    // Extract shot name from filename (e.g., <upload hash>_Front_View_<prompt digest>_v1.png)
+    let displayName = fileName;
+    for (const [key, value] of Object.entries(shotNameMap)) {
+        if (fileName.includes(key)) {
+            displayName = value;
+            break;
+        }
     }
+
+    const item = document.createElement('div');
+    item.className = 'gallery-item';
+    item.dataset.url = url;
+    item.innerHTML = `
+        <img src="${url}" alt="generated">
+        <div class="gallery-item-info">
+            <span>${displayName}</span>
+            <button class="download-btn" onclick="downloadImage('${url}', '${fileName}')">
+                <i class="fa-solid fa-download"></i>
+            </button>
+        </div>
+    `;
+    gallery.appendChild(item);
 }
 
 function showLoader() {
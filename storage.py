@@ -0,0 +1,286 @@
+import asyncio
+import mimetypes
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from loguru import logger
+from result_cache import file_digest
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local").lower()
+STORAGE_DB = Path(os.getenv("STORAGE_DB", "storage.db"))
+OUTPUT_DIR = Path(os.getenv("OUTPUT_DIR", "output_product_set"))
+UPLOAD_DIR = Path(os.getenv("UPLOAD_DIR", "uploads"))
+# Downscaled reference images sent to Gemini, shared by jobs with the same input
+PREPARED_DIR = Path(os.getenv("PREPARED_DIR", "prepared_refs"))
+# Retention: published outputs by age and total size, uploads and prepared references by age
+OUTPUT_RETENTION_DAYS = float(os.getenv("OUTPUT_RETENTION_DAYS", "14"))
+STORAGE_MAX_MB = float(os.getenv("STORAGE_MAX_MB", "700"))
+UPLOAD_RETENTION_HOURS = float(os.getenv("UPLOAD_RETENTION_HOURS", "72"))
+GC_INTERVAL_MINUTES = float(os.getenv("GC_INTERVAL_MINUTES", "30"))
+# S3-compatible object store (AWS, MinIO, R2...); needs the optional boto3 package
+S3_BUCKET = os.getenv("S3_BUCKET")
+S3_PREFIX = os.getenv("S3_PREFIX", "")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+S3_PUBLIC_URL = os.getenv("S3_PUBLIC_URL")
+S3_URL_EXPIRY_SECONDS = int(os.getenv("S3_URL_EXPIRY_SECONDS", "3600"))
+# With S3, local files are only a staging area kept this long for the cache and post-processing
+S3_LOCAL_RETENTION_HOURS = float(os.getenv("S3_LOCAL_RETENTION_HOURS", "24"))
+
+# Random id left in each data directory; processes reading the same ids share the directories
+VOLUME_MARKER = ".volume-id"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    remote INTEGER NOT NULL DEFAULT 0,
+    digest TEXT
+)
+"""
+
+class LocalStorage:
+    """Generated files under ``root``, indexed in a SQLite manifest.
+
+    The manifest records every published file (its key is the path relative to
+    ``root``), so serving and garbage collection never have to scan the output
+    directory. GC drops files older than ``max_age_days``, then the oldest ones
+    until the total is under ``max_mb``.
+    """
+
+    def __init__(self, root: Path = OUTPUT_DIR, db_path: Path = STORAGE_DB,
+                 max_age_days: float = OUTPUT_RETENTION_DAYS, max_mb: float = STORAGE_MAX_MB):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_age = max_age_days * 86400
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        # GC runs in a worker thread, so manifest access is serialised
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self._lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(SCHEMA)
+            self.db.execute("CREATE INDEX IF NOT EXISTS objects_created ON objects (created_at)")
+            columns = {row["name"] for row in self.db.execute("PRAGMA table_info(objects)")}
+            if "digest" not in columns:
+                self.db.execute("ALTER TABLE objects ADD COLUMN digest TEXT")
+
+    def key_for(self, path) -> str:
+        """Manifest key of a file under root, or None for files stored elsewhere."""
+        try:
+            return Path(path).resolve().relative_to(self.root.resolve()).as_posix()
+        except ValueError:
+            return None
+
+    def local_path(self, key: str) -> Path:
+        """Path of ``key`` under root; raises ValueError for keys escaping it."""
+        path = (self.root / key).resolve()
+        path.relative_to(self.root.resolve())
+        return path
+
+    def register(self, path, digest: str = None) -> str:
+        key = self.key_for(path)
+        if key is None:
+            return None
+        with self._lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO objects (key, size, created_at, remote, digest) VALUES (?, ?, ?, 0, ?)",
+                (key, Path(path).stat().st_size, time.time(), digest),
+            )
+        return key
+
+    async def publish(self, path) -> str:
+        """Adds a saved file to the store. Returns its key (None if it lives outside root)."""
+        if self.key_for(path) is None:
+            return None
+        # The content hash is the file's strong ETag and the version in its URL
+        digest = await asyncio.to_thread(file_digest, path)
+        return self.register(path, digest)
+
+    def lookup(self, key: str):
+        with self._lock:
+            row = self.db.execute("SELECT key, size, created_at, remote, digest FROM objects WHERE key = ?", (key,)).fetchone()
+        return dict(row) if row else None
+
+    def open(self, key: str):
+        """Binary file object for ``key``, or None if it is not available."""
+        try:
+            return open(self.local_path(key), "rb")
+        except (OSError, ValueError):
+            return None
+
+    def remote_url(self, key: str):
+        """URL to redirect to for a file that is no longer held locally (None: not available)."""
+        return None
+
+    def _delete_remote(self, key: str):
+        pass
+
+    def _unlink_local(self, key: str):
+        """Removes the local copy of ``key`` and the per-job directories it leaves empty."""
+        try:
+            path = self.local_path(key)
+        except ValueError:
+            return
+        path.unlink(missing_ok=True)
+        root = self.root.resolve()
+        for parent in path.parents:
+            if parent == root:
+                break
+            try:
+                parent.rmdir()
+            except OSError:
+                # Not empty (or already gone)
+                break
+
+    def delete(self, key: str):
+        self._delete_remote(key)
+        self._unlink_local(key)
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM objects WHERE key = ?", (key,))
+
+    def usage(self) -> int:
+        with self._lock:
+            return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+
+    def collect_garbage(self) -> int:
+        """Deletes expired files, then the oldest ones until under the size quota."""
+        removed = 0
+        cutoff = time.time() - self.max_age
+        with self._lock:
+            expired = self.db.execute("SELECT key FROM objects WHERE created_at < ?", (cutoff,)).fetchall()
+        for row in expired:
+            self.delete(row["key"])
+            removed += 1
+
+        total = self.usage()
+        if total > self.max_bytes:
+            with self._lock:
+                oldest = self.db.execute("SELECT key, size FROM objects ORDER BY created_at ASC").fetchall()
+            for row in oldest:
+                if total <= self.max_bytes:
+                    break
+                self.delete(row["key"])
+                total -= row["size"]
+                removed += 1
+
+        if removed:
+            logger.info(f"Storage GC removed {removed} file(s), {self.usage() / 1024 / 1024:.1f} MB in use")
+        return removed
+
+class S3Storage(LocalStorage):
+    """Publishes files to an S3-compatible bucket; local copies expire after ``local_retention_hours``.
+
+    Requests for files whose local copy is gone are redirected to the bucket
+    (``public_url`` if set, otherwise a presigned URL).
+    """
+
+    def __init__(self, bucket: str = S3_BUCKET, prefix: str = S3_PREFIX, endpoint_url: str = S3_ENDPOINT_URL,
+                 public_url: str = S3_PUBLIC_URL, local_retention_hours: float = S3_LOCAL_RETENTION_HOURS, **kwargs):
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError("STORAGE_BACKEND=s3 needs the boto3 package (pip install boto3)")
+        if not bucket:
+            raise RuntimeError("STORAGE_BACKEND=s3 needs S3_BUCKET")
+        super().__init__(**kwargs)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.public_url = public_url.rstrip("/") if public_url else None
+        self.local_retention = local_retention_hours * 3600
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+
+    async def publish(self, path) -> str:
+        key = await super().publish(path)
+        if key is None:
+            return None
+        content_type = mimetypes.guess_type(str(path))[0] or "application/octet-stream"
+        await asyncio.to_thread(
+            self.client.upload_file, str(path), self.bucket, self.prefix + key,
+            ExtraArgs={"ContentType": content_type},
+        )
+        with self._lock, self.db:
+            self.db.execute("UPDATE objects SET remote = 1 WHERE key = ?", (key,))
+        return key
+
+    def remote_url(self, key: str):
+        entry = self.lookup(key)
+        if not entry or not entry["remote"]:
+            return None
+        if self.public_url:
+            return f"{self.public_url}/{self.prefix}{key}"
+        return self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": self.prefix + key}, ExpiresIn=S3_URL_EXPIRY_SECONDS,
+        )
+
+    def open(self, key: str):
+        local = super().open(key)
+        if local is not None:
+            return local
+        entry = self.lookup(key)
+        if not entry or not entry["remote"]:
+            return None
+        return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)["Body"]
+
+    def _delete_remote(self, key: str):
+        entry = self.lookup(key)
+        if entry and entry["remote"]:
+            self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def collect_garbage(self) -> int:
+        removed = super().collect_garbage()
+        # Uploaded files only need their local staging copy for a while
+        cutoff = time.time() - self.local_retention
+        with self._lock:
+            staged = self.db.execute("SELECT key FROM objects WHERE remote = 1 AND created_at < ?", (cutoff,)).fetchall()
+        for row in staged:
+            self._unlink_local(row["key"])
+        return removed
+
+def volume_marker(directory: Path) -> str:
+    """Id stored in ``directory``, created by whichever process gets there first."""
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / VOLUME_MARKER
+    try:
+        with open(path, "x") as f:
+            f.write(uuid.uuid4().hex)
+    except FileExistsError:
+        pass
+    return path.read_text().strip()
+
+def data_volume_id() -> str:
+    """Identifies the uploads, outputs and storage manifest this process sees.
+
+    Job payloads carry local upload paths and the manifest is a SQLite file,
+    so every API and worker process must see the same directories.
+    """
+    return ":".join(volume_marker(d) for d in (UPLOAD_DIR, OUTPUT_DIR, STORAGE_DB.resolve().parent))
+
+def sweep_dir(directory: Path, max_age_hours: float = UPLOAD_RETENTION_HOURS, keep=None) -> int:
+    """Deletes files older than ``max_age_hours`` from a flat directory, except those ``keep(path)`` protects."""
+    if not directory.exists():
+        return 0
+    removed = 0
+    cutoff = time.time() - max_age_hours * 3600
+    for path in directory.iterdir():
+        try:
+            if path.name == VOLUME_MARKER:
+                continue
+            if path.is_file() and path.stat().st_mtime < cutoff and not (keep and keep(path)):
+                path.unlink()
+                removed += 1
+        except OSError as e:
+            logger.warning(f"Could not remove {path}: {e}")
+    if removed:
+        logger.info(f"Removed {removed} old file(s) from {directory}")
+    return removed
+
+def create_storage():
+    """The backend selected by STORAGE_BACKEND ("local" or "s3")."""
+    if STORAGE_BACKEND == "s3":
+        return S3Storage()
+    return LocalStorage()
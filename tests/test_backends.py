@@ -0,0 +1,226 @@
+"""Shared backends: the Redis job queue and progress broker, and S3 storage.
+
+These run against real services and are skipped unless one is configured:
+
+    TEST_REDIS_URL=redis://localhost:6379/15
+    TEST_S3_ENDPOINT_URL=http://localhost:9000 TEST_S3_BUCKET=probaho-test   # MinIO or any S3 API
+
+Every test works under its own key prefix and removes what it created.
+"""
+import asyncio
+import os
+import subprocess
+import sys
+import uuid
+from pathlib import Path
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from job_queue import QueueFull, RedisJobQueue
+from progress import RedisProgressBroker
+
+TEST_REDIS_URL = os.getenv("TEST_REDIS_URL")
+TEST_S3_ENDPOINT_URL = os.getenv("TEST_S3_ENDPOINT_URL")
+TEST_S3_BUCKET = os.getenv("TEST_S3_BUCKET")
+
+def run_python(code: str):
+    """Runs ``code`` in a separate interpreter, as another API or worker process would."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [str(REPO_DIR), env.get("PYTHONPATH")]))
+    result = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+@pytest.fixture
+def redis_prefix():
+    if not TEST_REDIS_URL:
+        pytest.skip("TEST_REDIS_URL is not set")
+    redis = pytest.importorskip("redis")
+    client = redis.Redis.from_url(TEST_REDIS_URL)
+    try:
+        client.ping()
+    except redis.RedisError as e:
+        pytest.skip(f"Redis at {TEST_REDIS_URL} is not reachable: {e}")
+    prefix = f"test-{uuid.uuid4().hex[:8]}:"
+    yield prefix
+    keys = list(client.scan_iter(match=prefix + "*"))
+    if keys:
+        client.delete(*keys)
+    client.close()
+
+def queued_state(**fields):
+    return {"status": "queued", "progress": 0, "message": "", "results": [], **fields}
+
+def test_redis_queue_orders_by_priority_then_takes_turns(redis_prefix):
+    async def scenario():
+        queue = RedisJobQueue(TEST_REDIS_URL, redis_prefix)
+        try:
+            for job_id, api_key, priority in [("a1", "a", 0), ("a2", "a", 0), ("b1", "b", 0), ("urgent", "b", 5)]:
+                await queue.enqueue(job_id, api_key, {"n": job_id}, queued_state(), priority=priority)
+            assert await queue.depth() == 4
+            assert await queue.position("urgent") == 1
+            return [(await queue.dequeue())[0] for _ in range(4)]
+        finally:
+            await queue.db.aclose()
+
+    assert asyncio.run(scenario()) == ["urgent", "a1", "b1", "a2"]
+
+def test_redis_queue_refuses_past_max_size(redis_prefix):
+    async def scenario():
+        queue = RedisJobQueue(TEST_REDIS_URL, redis_prefix, max_size=1)
+        try:
+            await queue.enqueue("first", "k", {}, queued_state())
+            with pytest.raises(QueueFull):
+                await queue.enqueue("second", "k", {}, queued_state())
+        finally:
+            await queue.db.aclose()
+
+    asyncio.run(scenario())
+
+def test_redis_queue_claims_each_job_once(redis_prefix):
+    async def scenario():
+        # Separate clients stand in for workers on different nodes
+        queues = [RedisJobQueue(TEST_REDIS_URL, redis_prefix) for _ in range(4)]
+        try:
+            for n in range(8):
+                await queues[0].enqueue(f"job{n}", f"key{n % 3}", {}, queued_state())
+            claims = await asyncio.gather(*(queue.dequeue() for queue in queues for _ in range(2)))
+            return [job_id for job_id, _ in claims]
+        finally:
+            for queue in queues:
+                await queue.db.aclose()
+
+    claimed = asyncio.run(scenario())
+    assert sorted(claimed) == [f"job{n}" for n in range(8)]
+
+def test_redis_queue_requeue_keeps_place_and_state(redis_prefix):
+    async def scenario():
+        queue = RedisJobQueue(TEST_REDIS_URL, redis_prefix)
+        try:
+            await queue.enqueue("old", "k", {"file_paths": ["uploads/a.png"]}, queued_state())
+            await queue.dequeue()
+            await queue.save_state("old", queued_state(status="failed", message="1 shot failed"))
+            assert await queue.referenced_files() == {"uploads/a.png"}
+            assert await queue.active() == []
+
+            await queue.enqueue("new", "k", {}, queued_state())
+            await queue.requeue("old", queued_state(message="Retrying"))
+            assert await queue.position("old") == 1
+            assert (await queue.get_state("old"))["message"] == "Retrying"
+            assert [job_id for job_id, _ in await queue.active()] == ["old", "new"]
+        finally:
+            await queue.db.aclose()
+
+    asyncio.run(scenario())
+
+def test_redis_queue_recovers_job_of_a_dead_worker(redis_prefix):
+    async def enqueue():
+        queue = RedisJobQueue(TEST_REDIS_URL, redis_prefix)
+        try:
+            await queue.enqueue("job1", "k", {"file_paths": []}, queued_state())
+        finally:
+            await queue.db.aclose()
+
+    asyncio.run(enqueue())
+    # Another process claims the job and exits without finishing it
+    claimed = run_python(
+        "import asyncio\n"
+        "from job_queue import RedisJobQueue\n"
+        "async def main():\n"
+        f"    queue = RedisJobQueue({TEST_REDIS_URL!r}, {redis_prefix!r})\n"
+        "    print((await queue.dequeue())[0])\n"
+        "    await queue.db.aclose()\n"
+        "asyncio.run(main())\n"
+    )
+    assert claimed.strip() == "job1"
+
+    async def recover():
+        queue = RedisJobQueue(TEST_REDIS_URL, redis_prefix)
+        try:
+            assert await queue.depth() == 0
+            # A live lease is left alone; an expired one is requeued
+            assert await queue.recover(stale_after=60) == 0
+            assert await queue.recover(stale_after=0) == 1
+            assert (await queue.get_state("job1"))["status"] == "queued"
+            return await queue.dequeue()
+        finally:
+            await queue.db.aclose()
+
+    assert asyncio.run(recover()) == ("job1", {"file_paths": []})
+
+def test_redis_progress_events_reach_other_processes(redis_prefix):
+    async def scenario():
+        broker = RedisProgressBroker(TEST_REDIS_URL, redis_prefix)
+        await broker.start()
+        try:
+            queue = broker.subscribe("job1")
+            # Published by another process, e.g. a worker on another node
+            await asyncio.to_thread(run_python, (
+                "import asyncio\n"
+                "from progress import RedisProgressBroker\n"
+                "async def main():\n"
+                f"    broker = RedisProgressBroker({TEST_REDIS_URL!r}, {redis_prefix!r})\n"
+                "    await broker.publish('job2', {'type': 'status', 'progress': 1})\n"
+                "    await broker.publish('job1', {'type': 'status', 'progress': 50})\n"
+                "    await broker.publish('job1', {'type': 'completed'})\n"
+                "    await broker.db.aclose()\n"
+                "asyncio.run(main())\n"
+            ))
+            return [await asyncio.wait_for(queue.get(), timeout=10) for _ in range(2)]
+        finally:
+            await broker.close()
+            await broker.db.aclose()
+
+    assert asyncio.run(scenario()) == [{"type": "status", "progress": 50}, {"type": "completed"}]
+
+@pytest.fixture
+def s3_storage(tmp_path):
+    if not (TEST_S3_ENDPOINT_URL and TEST_S3_BUCKET):
+        pytest.skip("TEST_S3_ENDPOINT_URL and TEST_S3_BUCKET are not set")
+    pytest.importorskip("boto3")
+    from storage import S3Storage
+
+    storage = S3Storage(
+        bucket=TEST_S3_BUCKET, prefix=f"test-{uuid.uuid4().hex[:8]}/", endpoint_url=TEST_S3_ENDPOINT_URL,
+        local_retention_hours=0, root=tmp_path / "outputs", db_path=tmp_path / "storage.db",
+    )
+    try:
+        storage.client.head_bucket(Bucket=TEST_S3_BUCKET)
+    except Exception:
+        try:
+            storage.client.create_bucket(Bucket=TEST_S3_BUCKET)
+        except Exception as e:
+            pytest.skip(f"S3 bucket {TEST_S3_BUCKET} at {TEST_S3_ENDPOINT_URL} is not usable: {e}")
+    yield storage
+    listed = storage.client.list_objects_v2(Bucket=TEST_S3_BUCKET, Prefix=storage.prefix)
+    for entry in listed.get("Contents", []):
+        storage.client.delete_object(Bucket=TEST_S3_BUCKET, Key=entry["Key"])
+
+def test_s3_serves_published_files_after_local_copy_expires(s3_storage):
+    path = s3_storage.root / "job1" / "a_front_v1.png"
+    path.parent.mkdir(parents=True)
+    path.write_bytes(b"png bytes")
+
+    key = asyncio.run(s3_storage.publish(path))
+    assert key == "job1/a_front_v1.png"
+    assert s3_storage.lookup(key)["remote"] == 1
+
+    # local_retention_hours=0: the staging copy goes, the object stays in the bucket
+    assert s3_storage.collect_garbage() == 0
+    assert not path.exists()
+    assert s3_storage.open(key).read() == b"png bytes"
+    assert s3_storage.prefix + key in s3_storage.remote_url(key)
+
+    s3_storage.delete(key)
+    assert s3_storage.lookup(key) is None
+    listed = s3_storage.client.list_objects_v2(Bucket=TEST_S3_BUCKET, Prefix=s3_storage.prefix)
+    assert listed.get("KeyCount", 0) == 0
+
+def test_s3_storage_refuses_missing_bucket():
+    pytest.importorskip("boto3")
+    from storage import S3Storage
+
+    with pytest.raises(RuntimeError, match="S3_BUCKET"):
+        S3Storage(bucket=None)
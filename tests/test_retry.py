@@ -0,0 +1,119 @@
+"""Retrying a job re-sends only the shots that failed.
+
+A job runs against the fake Gemini client (GEMINI_FAKE) in a subprocess with a
+fresh working directory. One shot's prompt fails on its first send; the job
+ends failed with the other shots saved, and a retry sends that shot alone.
+"""
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+FAILING_SHOT = "Side_View"
+
+PROBE = """
+import io, json, re, time
+from collections import Counter
+import fake_gemini
+from fastapi.testclient import TestClient
+from PIL import Image
+
+FAILING_SHOT = %r
+sent = []
+failed = []
+original_send = fake_gemini.FakeChat.send_message
+
+async def send_message(self, prompt, files=None, **kwargs):
+    shot = re.search(r"Generate the '(\\w+)' variant", prompt)
+    if shot:
+        sent.append(shot.group(1))
+        # The fake's own failure path: every send fails while the rate is 1
+        fail = shot.group(1) == FAILING_SHOT and not failed
+        self.client.failure_rate = 1.0 if fail else 0.0
+        if fail:
+            failed.append(shot.group(1))
+    return await original_send(self, prompt, files=files, **kwargs)
+
+fake_gemini.FakeChat.send_message = send_message
+
+import server
+
+headers = {"X-API-Key": "test_key"}
+image = io.BytesIO()
+Image.new("RGB", (64, 64), "white").save(image, "PNG")
+
+def wait(client, job_id):
+    for _ in range(600):
+        job = client.get(f"/status/{job_id}", headers=headers).json()
+        # A finished job's previews may still be building; it can only be retried after
+        if job["status"] in ("completed", "failed") and not job.get("variants_pending"):
+            return job
+        time.sleep(0.05)
+    raise TimeoutError(job)
+
+def shot_states(client, job_id):
+    images = client.portal.call(server.worker.job_queue.get_state, job_id)["images"]
+    return {name: shot["status"] for name, shot in images[0]["shots"].items()}
+
+with TestClient(server.app) as client:
+    job_id = client.post(
+        "/upload", files=[("files", ("product.png", image.getvalue()))],
+        data={"profile": "quick", "bypass_cache": "true"}, headers=headers,
+    ).json()["job_id"]
+    first = wait(client, job_id)
+    first_states = shot_states(client, job_id)
+    first_sent = Counter(sent)
+    sent.clear()
+
+    retry = client.post(f"/jobs/{job_id}/retry", headers=headers).json()
+    second = wait(client, job_id)
+    print(json.dumps({
+        "first": first["status"], "first_states": first_states, "first_sent": first_sent,
+        "retried": retry["shots"], "second": second["status"], "second_states": shot_states(client, job_id),
+        "second_sent": Counter(sent), "results": len(second["results"]),
+    }))
+""" % (FAILING_SHOT,)
+
+@pytest.fixture(scope="module")
+def retried(tmp_path_factory):
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": os.pathsep.join(filter(None, [str(REPO_DIR), env.get("PYTHONPATH")])),
+        "GEMINI_FAKE": "1",
+        "GEMINI_1PSID": "fake",
+        "GEMINI_1PSIDTS": "fake",
+        "MASTER_API_KEY": "test_key",
+        "GEMINI_FAKE_INIT_LATENCY": "0",
+        "GEMINI_FAKE_SEND_LATENCY": "0",
+        "GEMINI_FAKE_SAVE_LATENCY": "0",
+        "GEMINI_FAKE_IMAGE_SIZE": "64",
+        "GEMINI_SEND_RATE": "100",
+        "GEMINI_SEND_RATE_MAX": "100",
+        "GEMINI_SAVE_RATE": "100",
+        "GEMINI_SAVE_RATE_MAX": "100",
+        "GEMINI_RATE_BURST": "20",
+        "GEMINI_RETRY_ATTEMPTS": "1",
+        "WORKER_METRICS_PORT": "0",
+    })
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE], cwd=tmp_path_factory.mktemp("retry"), env=env,
+        capture_output=True, text=True, timeout=120,
+    )
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def test_failed_shot_fails_the_job_and_keeps_the_rest(retried):
+    assert retried["first"] == "failed"
+    assert retried["first_states"] == {"Front_View": "done", FAILING_SHOT: "failed", "Lifestyle": "done"}
+    assert retried["first_sent"] == {"Front_View": 1, FAILING_SHOT: 1, "Lifestyle": 1}
+
+def test_retry_resends_only_the_failed_shot(retried):
+    assert retried["retried"] == 1
+    assert retried["second_sent"] == {FAILING_SHOT: 1}
+    assert retried["second"] == "completed"
+    assert set(retried["second_states"].values()) == {"done"}
+    assert retried["results"] == 3
@@ -0,0 +1,58 @@
+"""Cold start: the server must answer /ping without loading the generator stack.
+
+The server is started in a subprocess with a fresh working directory, so the
+modules it loads and the files it creates are its own.
+"""
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from bench import STARTUP_BUDGET_SECONDS
+
+# Imported lazily by the workers, never by importing the server
+GENERATOR_STACK = ("gemini_webapi", "PIL", "img_service")
+
+PROBE = """
+import json, os, sys, time
+from fastapi.testclient import TestClient
+
+started = time.monotonic()
+import server
+imported = {"loaded": [m for m in %r if m in sys.modules], "files": sorted(os.listdir("."))}
+with TestClient(server.app) as client:
+    response = client.get("/ping")
+    print(json.dumps({**imported, "status": response.status_code, "seconds": time.monotonic() - started}))
+""" % (GENERATOR_STACK,)
+
+@pytest.fixture(scope="module")
+def startup(tmp_path_factory):
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": os.pathsep.join(filter(None, [str(REPO_DIR), env.get("PYTHONPATH")])),
+        "GEMINI_FAKE": "1",
+        "GEMINI_1PSID": "fake",
+        "GEMINI_1PSIDTS": "fake",
+        "MASTER_API_KEY": "test_key",
+    })
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE], cwd=tmp_path_factory.mktemp("startup"), env=env,
+        capture_output=True, text=True, timeout=120,
+    )
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def test_import_skips_generator_stack(startup):
+    assert startup["loaded"] == []
+
+def test_import_creates_no_files(startup):
+    assert startup["files"] == []
+
+def test_ping_within_startup_budget(startup):
+    assert startup["status"] == 200
+    assert startup["seconds"] < STARTUP_BUDGET_SECONDS
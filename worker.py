@@ -0,0 +1,545 @@
+"""Generation tier: pulls jobs off the shared queue, runs them and publishes progress.
+
+The API server runs these workers in-process unless RUN_WORKERS=0; with
+JOB_BACKEND=redis they can also run as separate processes (``python worker.py``),
+so the API and generation tiers scale independently. Job payloads carry local
+upload paths and the storage manifest is a SQLite file, so every process must
+see the same UPLOAD_DIR, OUTPUT_DIR and STORAGE_DB: the same host, or nodes
+sharing one data volume. Worker processes check this at startup (see
+check_data_volume) and serve their own metrics on WORKER_METRICS_PORT.
+"""
+import os
+from dotenv import load_dotenv
+
+# Load .env before the modules below read their configuration
+load_dotenv()
+
+import asyncio
+import importlib
+import signal
+import time
+from pathlib import Path
+from typing import List
+from loguru import logger
+from accounts import load_accounts
+from job_queue import JOB_LEASE_SECONDS, QueueFull, create_job_queue
+from progress import VARIANTS_DONE, create_progress_broker
+from rate_limit import backoff_delay
+import metrics
+from result_cache import ResultCache
+from shot_profiles import get_profile
+import storage as storage_backends
+from storage import OUTPUT_DIR
+
+# Jobs each Gemini account runs at once (its client slots); every slot gets a worker
+ACCOUNT_CONCURRENCY = int(os.getenv("ACCOUNT_CONCURRENCY", "2"))
+# Accounts a job may go through when one is throttled, expired or fails to start a client
+JOB_ACCOUNT_ATTEMPTS = int(os.getenv("JOB_ACCOUNT_ATTEMPTS", "3"))
+# Optional cap on the jobs this process runs at once, whatever the number of accounts
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "0"))
+# Cookie syncs are broadcast here so every worker process rebuilds its clients
+ACCOUNTS_CHANNEL = "_accounts"
+# Prometheus scrape port of a standalone worker process (0 = off); give each process on a host its own
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9100"))
+WORKER_METRICS_HOST = os.getenv("WORKER_METRICS_HOST", "0.0.0.0")
+
+# Job queue, progress events, result cache and the store behind /outputs (local
+# disk or S3-compatible, with age/size GC). Created by open_backends() at startup,
+# so importing this module touches no files, databases or sockets.
+job_queue = None
+progress_broker = None
+result_cache = None
+storage = None
+# Warm Gemini clients for every configured account, shared across jobs. The
+# generator stack behind it (gemini_webapi, httpx, Pillow) is imported on first
+# use, in a thread, so a cold-started server answers requests right away.
+client_pool = None
+# Set once the pool's first warm-up has finished (see /ready)
+pool_warm = False
+_stack_lock = asyncio.Lock()
+
+# Working copy of the jobs this process is running; every change is written
+# through to the job queue, which is what the API tier reads.
+jobs = {}
+# Worker loops of this process; more are started when accounts are added
+worker_tasks = []
+# Finished jobs whose variants are still being built (see finish_variants), and those tasks
+finishing = {}
+variant_tasks = set()
+
+def open_backends():
+    """Creates the shared backends on first call; later calls are no-ops."""
+    global job_queue, progress_broker, result_cache, storage
+    if job_queue is None:
+        storage = storage_backends.create_storage()
+        result_cache = ResultCache()
+        job_queue = create_job_queue()
+        progress_broker = create_progress_broker()
+
+async def claim_data_volume():
+    """Records the data directories the API process sees, for workers to check against."""
+    await job_queue.set_meta("data_volume", storage_backends.data_volume_id())
+
+async def check_data_volume():
+    """Refuses to run on a node that does not share the API's data directories."""
+    expected = await job_queue.get_meta("data_volume")
+    actual = storage_backends.data_volume_id()
+    if expected is None:
+        await job_queue.set_meta("data_volume", actual)
+    elif expected != actual:
+        raise RuntimeError(
+            "This worker does not see the API's UPLOAD_DIR, OUTPUT_DIR and STORAGE_DB; "
+            "run it on the same host or mount the same data volume"
+        )
+
+def _import_generator_stack():
+    # Pillow is needed as soon as the first image is saved
+    importlib.import_module("postprocess")
+    from client_pool import ClientPool
+    return ClientPool
+
+async def load_client_pool():
+    """The shared client pool, importing the generator stack on first call."""
+    global client_pool
+    async with _stack_lock:
+        if client_pool is None:
+            started = time.monotonic()
+            ClientPool = await asyncio.to_thread(_import_generator_stack)
+            client_pool = ClientPool(ACCOUNT_CONCURRENCY, load_accounts, storage=storage)
+            logger.info(f"Generator stack loaded in {time.monotonic() - started:.2f}s")
+    return client_pool
+
+async def warm_up():
+    global pool_warm
+    pool = await load_client_pool()
+    await pool.warm()
+    pool_warm = True
+
+async def update_job(job_id: str, event: str = "status", **fields):
+    """Updates, persists and publishes job state.
+
+    The published event carries only the changed fields; the growing results
+    and variants collections are left to the final event and to /status.
+    """
+    jobs[job_id].update(fields)
+    await job_queue.save_state(job_id, jobs[job_id])
+    if event not in ("completed", "failed"):
+        fields.pop("results", None)
+        fields.pop("variants", None)
+    await progress_broker.publish(job_id, {"type": event, **fields})
+
+def new_shot_states(file_names, shot_names) -> list:
+    """Per-image, per-shot checkpoint: pending/running/done/failed plus the saved files."""
+    return [
+        {"name": name, "shots": {shot_name: {"status": "pending", "files": []} for shot_name in shot_names}}
+        for name in file_names
+    ]
+
+async def update_shot(job_id: str, idx: int, shot_name: str, **fields):
+    """Checkpoints one shot so a retry or a restart can skip it once done."""
+    jobs[job_id]["images"][idx]["shots"][shot_name].update(fields)
+    await job_queue.save_state(job_id, jobs[job_id])
+    await progress_broker.publish(job_id, {"type": "shot_state", "image": idx + 1, "shot": shot_name, **fields})
+
+def saved_results(job: dict) -> list:
+    """URLs of every finished shot, image by image in profile order."""
+    return [url for image in job["images"] for shot in image["shots"].values() for url in shot["files"]]
+
+def output_url(path) -> str:
+    """Public URL of a generated file, versioned by its content hash so it can be cached forever."""
+    key = Path(path).resolve().relative_to(OUTPUT_DIR.resolve()).as_posix()
+    entry = storage.lookup(key)
+    if entry and entry.get("digest"):
+        return f"/outputs/{key}?v={entry['digest'][:16]}"
+    return f"/outputs/{key}"
+
+async def release_uploads(job_id: str, file_paths: List[Path], queued_at: float):
+    """Deletes a completed job's uploads unless another job still needs them.
+
+    Uploads are shared by content hash; a file re-uploaded after this job was
+    queued may belong to a job that is just being queued, so it is left to the GC.
+    """
+    needed = await job_queue.referenced_files(exclude=job_id)
+    for path in file_paths:
+        try:
+            if str(path) not in needed and path.stat().st_mtime <= queued_at:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+async def run_generation_task(job_id: str, file_paths: List[Path], bypass_cache: bool = False, file_names: List[str] = None,
+                              profile: str = None):
+    # Already imported by the time a job runs (load_client_pool)
+    import postprocess
+    from client_pool import AccountUnavailable
+    from img_service import ShotsFailed, is_account_error
+
+    # Trace spans recorded by this task (and the tasks it spawns) carry the job id
+    metrics.current_job.set(job_id)
+    started = time.time()
+    if jobs[job_id].get("queued_at"):
+        metrics.STAGE_SECONDS.observe(started - jobs[job_id]["queued_at"], stage="queue_wait", shot="", outcome="ok")
+    await update_job(job_id, event="started", status="processing")
+    postprocessing = []
+    # Uploads are stored by content hash; keep the client's names for messages
+    file_names = file_names or [p.name for p in file_paths]
+    images = jobs[job_id].setdefault("images", [])
+    # Jobs never share output files, so a bypass_cache run cannot overwrite another job's images
+    job_dir = OUTPUT_DIR / job_id
+
+    def shots_done():
+        return sum(1 for image in images for shot in image["shots"].values() if shot["status"] == "done")
+
+    async def build_variants(path):
+        """Derivatives for one saved image, published as soon as they are ready."""
+        try:
+            variants = await postprocess.process_images([path])
+            if path not in variants:
+                return
+            for variant_path in variants[path].values():
+                try:
+                    await storage.publish(variant_path)
+                except Exception as e:
+                    logger.error(f"Could not publish {variant_path} to storage: {e}")
+            urls = {name: output_url(p) for name, p in variants[path].items()}
+            await record_variants(job_id, output_url(path), urls)
+        except Exception as e:
+            # The saved original stands on its own; only its previews are missing
+            logger.error(f"Job {job_id}: could not build variants of {path}: {e}")
+
+    try:
+        shot_profile = get_profile(profile)
+        if not images:
+            images.extend(new_shot_states(file_names, shot_profile.shot_names))
+        total_shots = sum(len(image["shots"]) for image in images)
+
+        async def generate_images(job_generator):
+            """Runs the unfinished shots of every image on one account's client."""
+            total_files = len(file_paths)
+            for idx, file_path in enumerate(file_paths):
+                # Shots finished by an earlier attempt are kept; only the rest are generated
+                todo = [name for name, shot in images[idx]["shots"].items() if shot["status"] != "done"]
+                if not todo:
+                    continue
+                await update_job(job_id, message=f"Processing image {idx + 1}/{total_files}: {file_names[idx]}")
+
+                async def progress_update(data):
+                    fields = {"message": f"Image {idx + 1}/{total_files}: {data['message']}"}
+                    if data["status"] == "generating":
+                        await update_shot(job_id, idx, data["shot"], status="running")
+                    elif data["status"] in ("shot_done", "cached"):
+                        await update_shot(job_id, idx, data["shot"], status="done", error=None,
+                                    files=[output_url(path) for path in data["files"]])
+                    elif data["status"] == "shot_failed":
+                        await update_shot(job_id, idx, data["shot"], status="failed", error=data["error"])
+                    fields["progress"] = shots_done() / total_shots * 100
+                    await update_job(job_id, **fields)
+
+                    if data["status"] == "generating":
+                        await progress_broker.publish(job_id, {"type": "shot_started", "image": idx + 1, "shot": data["shot"]})
+                    elif data["status"] == "saved":
+                        await progress_broker.publish(job_id, {
+                            "type": "image_saved", "image": idx + 1, "shot": data["shot"],
+                            "url": output_url(data["path"]),
+                        })
+                        # Resize/convert in the process pool while the next shot is generated
+                        postprocessing.append(asyncio.create_task(build_variants(data["path"])))
+                    elif data["status"] == "cached":
+                        for path in data["files"]:
+                            await progress_broker.publish(job_id, {
+                                "type": "image_saved", "image": idx + 1, "shot": data["shot"],
+                                "url": output_url(path), "cached": True,
+                            })
+                            postprocessing.append(asyncio.create_task(build_variants(path)))
+
+                try:
+                    await job_generator.generate_for_image(
+                        file_path, job_dir, progress_callback=progress_update,
+                        cache=result_cache, bypass_cache=bypass_cache, shots=todo, profile=shot_profile
+                    )
+                except ShotsFailed as e:
+                    # The other shots are saved; move on and leave these for /jobs/{id}/retry
+                    logger.warning(f"Job {job_id}, image {file_names[idx]}: {e}")
+                    pool.report(job_generator, e)
+                except Exception as e:
+                    if is_account_error(e):
+                        # The account is unusable for the remaining images too; the job moves to another
+                        raise
+                    # E.g. the reference upload failed: give up on this image only
+                    logger.warning(f"Job {job_id}, image {file_names[idx]} failed: {e}")
+                    pool.report(job_generator, e)
+                    for shot_name, shot in images[idx]["shots"].items():
+                        if shot["status"] != "done":
+                            await update_shot(job_id, idx, shot_name, status="failed", error=str(e))
+
+                await update_job(job_id, results=saved_results(jobs[job_id]))
+
+        await update_job(job_id, message="Waiting for an available Gemini account...")
+        pool = await load_client_pool()
+        for attempt in range(1, JOB_ACCOUNT_ATTEMPTS + 1):
+            try:
+                # Borrow a warm client from the least loaded account; it is recycled if the job fails
+                async with pool.acquire() as job_generator:
+                    await generate_images(job_generator)
+                break
+            except Exception as e:
+                if not (isinstance(e, AccountUnavailable) or is_account_error(e)) or attempt == JOB_ACCOUNT_ATTEMPTS:
+                    raise
+                # The pool has put that account on cooldown; carry on with another one
+                logger.warning(f"Job {job_id}: switching Gemini account after: {e}")
+                for idx, image in enumerate(images):
+                    for shot_name, shot in image["shots"].items():
+                        if shot["status"] == "running":
+                            await update_shot(job_id, idx, shot_name, status="pending")
+                await update_job(job_id, message="Switching to another Gemini account...")
+
+        # Variants still being built are recorded after the job completes (see finish_variants)
+        variants_pending = not all(task.done() for task in postprocessing)
+        failed = total_shots - shots_done()
+        if failed:
+            await update_job(
+                job_id, event="failed", status="failed", progress=100,
+                message=f"{failed} of {total_shots} shots failed. Retry the job to re-run only those shots.",
+                results=saved_results(jobs[job_id]), variants=jobs[job_id].get("variants", {}),
+                variants_pending=variants_pending
+            )
+            outcome = "failed"
+        else:
+            await update_job(
+                job_id, event="completed", status="completed", progress=100,
+                message="All images generated successfully!", results=saved_results(jobs[job_id]),
+                variants=jobs[job_id].get("variants", {}), variants_pending=variants_pending
+            )
+            outcome = "completed"
+            # Every shot is saved, so a retry can never need the inputs again
+            await release_uploads(job_id, file_paths, jobs[job_id].get("queued_at", started))
+        
+    except Exception as e:
+        logger.error(f"Job {job_id} failed: {e}")
+        # Shots cut short by the failure can be retried; finished ones keep their files
+        for idx, image in enumerate(images):
+            for shot_name, shot in image["shots"].items():
+                if shot["status"] == "running":
+                    await update_shot(job_id, idx, shot_name, status="failed", error=str(e))
+        # Images saved before the failure still get their variants, after the job has ended
+        await update_job(
+            job_id, event="failed", status="failed", message=f"Error: {str(e)}", results=saved_results(jobs[job_id]),
+            variants=jobs[job_id].get("variants", {}),
+            variants_pending=not all(task.done() for task in postprocessing)
+        )
+        outcome = "failed"
+
+    metrics.JOBS_TOTAL.inc(outcome=outcome)
+    metrics.JOB_SECONDS.observe(time.time() - started, outcome=outcome)
+    metrics.write_span({
+        "job_id": job_id, "stage": "job", "outcome": outcome, "images": len(file_paths),
+        "results": len(jobs[job_id]["results"]), "start": started, "duration": round(time.time() - started, 4),
+    })
+    # The queue holds the final state; this process no longer needs its copy
+    state = jobs.pop(job_id)
+    pending = [task for task in postprocessing if not task.done()]
+    if pending:
+        # Free the worker for the next job while the process pool finishes the previews
+        finishing[job_id] = state
+        task = asyncio.create_task(finish_variants(job_id, pending))
+        variant_tasks.add(task)
+        task.add_done_callback(variant_tasks.discard)
+
+async def record_variants(job_id: str, url: str, urls: dict):
+    """Adds one image's variants to the job, while it runs or after it has finished."""
+    state = jobs.get(job_id) or finishing.get(job_id)
+    if state is None:
+        return
+    state["variants"] = {**state.get("variants", {}), url: urls}
+    await job_queue.save_state(job_id, state)
+    await progress_broker.publish(job_id, {"type": "variants_ready", "url": url, "variants": urls})
+
+async def finish_variants(job_id: str, tasks: list):
+    """Waits for a finished job's remaining variants, then marks its variants complete.
+
+    Runs outside the worker loop, so the worker is already on its next job. The
+    job cannot be retried until this is done (see variants_pending), so its state
+    has no other writer meanwhile.
+    """
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        state = finishing.pop(job_id)
+        state["variants_pending"] = False
+        try:
+            await job_queue.save_state(job_id, state)
+            await progress_broker.publish(job_id, {"type": VARIANTS_DONE, "variants_pending": False})
+        except Exception as e:
+            logger.error(f"Job {job_id}: could not record that its variants are done: {e}")
+
+async def renew_lease(job_id: str):
+    """Keeps a running job from being requeued by another process's reaper."""
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        try:
+            await job_queue.renew(job_id)
+        except Exception as e:
+            # Try again next round; the lease only lapses after JOB_LEASE_SECONDS
+            logger.error(f"Renewing the lease of {job_id} failed: {e}")
+
+async def worker_loop(worker_id: int):
+    """Pulls jobs off the queue one at a time.
+
+    Queue or state errors (a Redis blip, a locked SQLite database) are logged
+    and retried with backoff, so they never end the worker. A job cut short by
+    one is left to the reaper once its lease expires.
+    """
+    failures = 0
+    while True:
+        job_id = None
+        try:
+            job_id, payload = await job_queue.dequeue()
+            # The latest state lives in the queue (another process may have enqueued or retried it)
+            state = await job_queue.get_state(job_id)
+            if state is None:
+                logger.warning(f"Worker {worker_id} claimed {job_id}, but its state is gone")
+                continue
+            jobs[job_id] = state
+            logger.info(f"Worker {worker_id} picked up {job_id}")
+            lease = asyncio.create_task(renew_lease(job_id))
+            try:
+                await run_generation_task(
+                    job_id, [Path(p) for p in payload["file_paths"]],
+                    bypass_cache=payload.get("bypass_cache", False), file_names=payload.get("file_names"),
+                    profile=payload.get("profile")
+                )
+            finally:
+                lease.cancel()
+            failures = 0
+        except Exception as e:
+            delay = backoff_delay(failures, base=1, cap=30)
+            failures += 1
+            logger.error(f"Worker {worker_id} failed{f' on {job_id}' if job_id else ''}: {e}. Resuming in {delay:.1f}s")
+            # Nothing here renews the job any more; the reaper hands it to another worker
+            jobs.pop(job_id, None)
+            await asyncio.sleep(delay)
+
+async def reap_loop():
+    """Requeues jobs whose worker process died (their lease was not renewed)."""
+    while True:
+        try:
+            await job_queue.recover(stale_after=JOB_LEASE_SECONDS)
+        except Exception as e:
+            logger.error(f"Requeueing stale jobs failed: {e}")
+        await asyncio.sleep(JOB_LEASE_SECONDS / 2)
+
+async def watch_accounts():
+    """Rebuilds this process's clients when cookies are synced through any API process."""
+    queue = progress_broker.subscribe(ACCOUNTS_CHANNEL)
+    try:
+        while True:
+            event = await queue.get()
+            pool = await load_client_pool()
+            await pool.rebuild(event.get("account"))
+            # A newly synced account brings its own slots
+            scale_workers()
+    finally:
+        progress_broker.unsubscribe(ACCOUNTS_CHANNEL, queue)
+
+def worker_count() -> int:
+    """One worker per account slot, so adding accounts adds throughput (up to MAX_WORKERS)."""
+    slots = max(1, len(load_accounts())) * max(1, ACCOUNT_CONCURRENCY)
+    return min(slots, MAX_WORKERS) if MAX_WORKERS > 0 else slots
+
+def scale_workers():
+    """Starts worker loops until there is one per account slot."""
+    while len(worker_tasks) < worker_count():
+        worker_tasks.append(asyncio.create_task(worker_loop(len(worker_tasks))))
+
+def start_workers() -> list:
+    """Warms the client pool and starts the workers plus their housekeeping tasks."""
+    tasks = [
+        asyncio.create_task(warm_up()),
+        asyncio.create_task(reap_loop()),
+        asyncio.create_task(watch_accounts()),
+    ]
+    scale_workers()
+    return tasks
+
+async def stop_workers(tasks: list):
+    """Stops the workers and hands their unfinished jobs back to the queue."""
+    tasks = tasks + worker_tasks
+    worker_tasks.clear()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # Finished jobs keep the variants built so far
+    pending = list(variant_tasks)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    for job_id, state in list(jobs.items()):
+        state.update(status="queued", message="Worker stopped, waiting for another worker...")
+        try:
+            await job_queue.requeue(job_id, state)
+        except QueueFull:
+            # Left processing; a reaper requeues it once its lease expires
+            logger.warning(f"Could not requeue {job_id} on shutdown: queue is full")
+    if client_pool is not None:
+        import postprocess
+        postprocess.shutdown()
+        await client_pool.close()
+
+async def update_metrics():
+    """Refreshes the gauges read at scrape time."""
+    metrics.QUEUE_DEPTH.set(await job_queue.depth())
+    if client_pool is not None:
+        metrics.CLIENTS_READY.set(client_pool.ready_count())
+        for name, account in client_pool.accounts.items():
+            metrics.ACCOUNT_ERROR_RATE.set(round(account.error_rate, 4), account=name)
+
+async def serve_metrics(port: int = WORKER_METRICS_PORT, host: str = WORKER_METRICS_HOST):
+    """Minimal HTTP endpoint for Prometheus: GET /metrics, anything else 404."""
+    async def handle(reader, writer):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            parts = request.split(b" ", 2)
+            if len(parts) > 1 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+                await update_metrics()
+                status, body = "200 OK", metrics.render_all().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"Worker metrics on http://{host}:{port}/metrics")
+    return server
+
+async def main():
+    open_backends()
+    await check_data_volume()
+    await progress_broker.start()
+    metrics_server = None
+    if WORKER_METRICS_PORT:
+        try:
+            metrics_server = await serve_metrics()
+        except OSError as e:
+            logger.error(f"Could not serve worker metrics on port {WORKER_METRICS_PORT}: {e}")
+    tasks = start_workers()
+    logger.info(f"Worker process running {len(worker_tasks)} worker(s)")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+    logger.info("Worker process shutting down")
+    await stop_workers(tasks)
+    if metrics_server is not None:
+        metrics_server.close()
+    await progress_broker.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())